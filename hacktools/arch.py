@@ -132,7 +132,7 @@ def compress(data):
         if pair[1] < 4:
             break
         dictkey = dictkeys.pop()
-        common.logDebug("setting pair", common.toHex(pair[0][0]), common.toHex(pair[0][1]), "with", pair[1], "occurrences as dict key", common.toHex(dictkey))
+        common.logDebug("setting pair", common.Lazy(common.toHex, pair[0][0]), common.Lazy(common.toHex, pair[0][1]), "with", pair[1], "occurrences as dict key", common.Lazy(common.toHex, dictkey))
         dictvalues[dictkey] = pair[0]
         content = content.replace(bytes(pair[0]), bytes([dictkey]))
     with common.Stream() as f:
@@ -151,7 +151,7 @@ def compress(data):
         else:
             for i in range(len(ordkeys)):
                 dictkey = ordkeys[i]
-                common.logDebug("Writing key", common.toHex(dictkey))
+                common.logDebug("Writing key", common.Lazy(common.toHex, dictkey))
                 # If the key is not consecutive, we need to skip places
                 if dictkey > currentkey:
                     keydiff = dictkey - currentkey
@@ -172,7 +172,7 @@ def compress(data):
                             consecutive += 1
                     f.writeByte(consecutive - 1)
                     isconsecutive = True
-                common.logDebug("Writing key pairs", common.toHex(dictvalues[dictkey][0]), common.toHex(dictvalues[dictkey][1]))
+                common.logDebug("Writing key pairs", common.Lazy(common.toHex, dictvalues[dictkey][0]), common.Lazy(common.toHex, dictvalues[dictkey][1]))
                 f.writeByte(dictvalues[dictkey][0])
                 # Don't write the 2nd byte if it's the same as the index (shouldn't happen)
                 if dictvalues[dictkey][1] != dictkey:
@@ -200,10 +200,8 @@ def compress(data):
 
 
 def decompress(data, declen):
-    with common.Stream() as f:
+    with common.Stream.fromBuffer(data) as f:
         with common.Stream() as fout:
-            f.write(data)
-            f.seek(0)
             # Based on Tinke's ARCH implementation
             buffer1 = []
             buffer2 = []
@@ -1,9 +1,15 @@
+import array
+import bisect
 import codecs
-from io import BytesIO, StringIO
+import functools
+import json
+from io import BytesIO, StringIO, UnsupportedOperation
 import xml.etree.ElementTree as ET
 import logging
 import math
+import mmap
 import os
+import pickle
 import re
 import shlex
 import shutil
@@ -13,6 +19,7 @@ import struct
 import subprocess
 import typing
 import zlib
+from hacktools import profile
 
 hasClick = False
 hasTqdm = False
@@ -31,62 +38,278 @@ except ImportError:
     pass
 
 table = {}
+stringtable = bytes.maketrans(b"\x82\x86", b"  ")
+lownibbles = bytes(i & 0x0f for i in range(0x100))
+highnibbles = bytes(i >> 4 for i in range(0x100))
 
 
 # File reading
+class BufferFile(object):
+    # Minimal file object over an existing buffer, slicing returns bytes like mmap
+    def __init__(self, buf):
+        self.view = memoryview(buf).cast("B")
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def __getitem__(self, key):
+        return bytes(self.view[key])
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += len(self.view)
+        if pos < 0:
+            raise ValueError("negative seek position " + str(pos))
+        self.pos = pos
+        return self.pos
+
+    def read(self, n=-1):
+        ret = self.view[self.pos:] if n < 0 else self.view[self.pos:self.pos + n]
+        self.pos += len(ret)
+        return bytes(ret)
+
+    def write(self, data):
+        if self.view.readonly:
+            raise UnsupportedOperation("write")
+        if self.pos + len(data) > len(self.view):
+            raise ValueError("data out of range")
+        self.view[self.pos:self.pos + len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def find(self, sub, start=0):
+        match = re.compile(re.escape(sub)).search(self.view, start)
+        return -1 if match is None else match.start()
+
+    def flush(self):
+        pass
+
+    def truncate(self, size=None):
+        raise UnsupportedOperation("truncate")
+
+    def close(self):
+        self.view.release()
+
+
 class Stream(object):
-    def __init__(self, fpath="", mode="m", little=True):
+    def __init__(self, fpath="", mode="m", little=True, buffered=False):
         self.f = fpath
         self.mode = mode
         self.endian = "<" if little else ">"
         self.half = None
+        self.file = None
+        self.view = None
+        # File descriptor used for positional reads that don't move the cursor
+        self.fd = -1
+        # Buffered streams collect sequential writes and defer *At writes until flush/close
+        self.buffered = buffered
+        self.buffer = bytearray()
+        self.bufferpos = 0
+        self.patches = []
+        self.patchstart = 0
+        self.patchend = 0
+
+    @staticmethod
+    def fromBuffer(buf, little=True):
+        # Wrap an existing bytes/bytearray/memoryview without copying it, writable if the buffer is
+        stream = Stream("", "buffer", little)
+        stream.f = BufferFile(buf)
+        stream.view = stream.f.view
+        return stream
 
     def __enter__(self):
         if self.mode == "m":
             self.f = BytesIO()
+        elif self.mode == "buffer":
+            # Already set up by fromBuffer
+            pass
+        elif self.mode == "mmap":
+            self.file = open(self.f, "rb")
+            if os.fstat(self.file.fileno()).st_size == 0:
+                # Empty files can't be mapped
+                self.f = self.file
+            else:
+                self.f = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.f)
         else:
             self.f = open(self.f, self.mode)
+            if self.mode == "rb" and hasattr(os, "pread"):
+                self.fd = self.f.fileno()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.f.close()
+        self.close()
 
     def close(self):
-        self.f.close()
+        if self.buffered:
+            self.flush()
+        if profile.enabled and self.mode != "m" and self.mode != "buffer":
+            profile.countFile(self.mode)
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        try:
+            self.f.close()
+        except BufferError:
+            # Slices returned by readView are still alive, the mapping will be freed with them
+            pass
+        if self.file is not None:
+            self.file.close()
 
     def tell(self):
+        if len(self.buffer) > 0:
+            return self.bufferpos + len(self.buffer)
         return self.f.tell()
 
     def seek(self, pos, whence=0):
+        if len(self.buffer) > 0:
+            self.flushBuffer()
         self.f.seek(pos, whence)
 
+    def countIO(self, name, n):
+        # Only file streams are counted, slicing a mapped file through f directly isn't
+        if self.mode != "m" and self.mode != "buffer":
+            profile.count(name, n)
+
     def read(self, n=-1):
-        return self.f.read(n)
+        if self.buffered:
+            self.flush()
+        ret = self.f.read(n)
+        if profile.enabled:
+            self.countIO("bytes read", len(ret))
+        return ret
+
+    def readInto(self, buf):
+        if self.view is not None:
+            data = self.readView(len(buf))
+            buf[:len(data)] = data
+            return len(data)
+        if self.buffered:
+            self.flush()
+        ret = self.f.readinto(buf)
+        if profile.enabled:
+            self.countIO("bytes read", ret)
+        return ret
 
     def readAt(self, pos, n=-1):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.read(n)
-        self.seek(current)
+        if self.view is not None:
+            ret = self.f[pos:] if n < 0 else self.f[pos:pos + n]
+        elif self.fd >= 0:
+            if n < 0:
+                n = max(0, os.fstat(self.fd).st_size - pos)
+            ret = os.pread(self.fd, n, pos)
+        else:
+            current = self.tell()
+            self.seek(pos)
+            ret = self.read(n)
+            self.seek(current)
+            return ret
+        if profile.enabled:
+            self.countIO("bytes read", len(ret))
         return ret
 
+    def readView(self, n=-1):
+        if self.view is None:
+            return memoryview(self.read(n))
+        pos = self.tell()
+        ret = self.view[pos:] if n < 0 else self.view[pos:pos + n]
+        self.seek(pos + len(ret))
+        if profile.enabled:
+            self.countIO("bytes read", len(ret))
+        return ret
+
+    def readViewAt(self, pos, n=-1):
+        if self.view is None:
+            return memoryview(self.readAt(pos, n))
+        ret = self.view[pos:] if n < 0 else self.view[pos:pos + n]
+        if profile.enabled:
+            self.countIO("bytes read", len(ret))
+        return ret
+
+    def unpackAt(self, pos, format):
+        if self.view is not None:
+            if profile.enabled:
+                self.countIO("bytes read", struct.calcsize(self.endian + format))
+            return struct.unpack_from(self.endian + format, self.view, pos)[0]
+        return struct.unpack(self.endian + format, self.readAt(pos, struct.calcsize(self.endian + format)))[0]
+
     def write(self, data):
-        self.f.write(data)
+        if not self.buffered:
+            self.f.write(data)
+            if profile.enabled:
+                self.countIO("bytes written", len(data))
+            return
+        if len(self.buffer) == 0:
+            self.bufferpos = self.f.tell()
+        pos = self.bufferpos + len(self.buffer)
+        if len(self.patches) > 0 and pos < self.patchend and pos + len(data) > self.patchstart:
+            # Don't let a pending patch overwrite newer data
+            self.flush()
+            self.bufferpos = self.f.tell()
+        self.buffer += data
+        if len(self.buffer) >= 0x100000:
+            self.flushBuffer()
 
     def writeAt(self, pos, data):
+        if self.buffered:
+            if len(self.patches) == 0:
+                self.patchstart = pos
+                self.patchend = pos + len(data)
+            else:
+                self.patchstart = min(self.patchstart, pos)
+                self.patchend = max(self.patchend, pos + len(data))
+            self.patches.append((pos, bytes(data)))
+            return
         current = self.tell()
         self.seek(pos)
         self.write(data)
         self.seek(current)
 
+    def packAt(self, pos, format, num):
+        self.writeAt(pos, struct.pack(self.endian + format, num))
+
+    def flushBuffer(self):
+        self.f.seek(self.bufferpos)
+        self.f.write(self.buffer)
+        if profile.enabled:
+            self.countIO("bytes written", len(self.buffer))
+        self.buffer = bytearray()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.flushBuffer()
+        if len(self.patches) > 0:
+            current = self.f.tell()
+            # Apply the patches in a single sorted pass, unless they overlap and the order matters
+            patches = sorted(self.patches, key=lambda x: x[0])
+            for i in range(1, len(patches)):
+                if patches[i - 1][0] + len(patches[i - 1][1]) > patches[i][0]:
+                    patches = self.patches
+                    break
+            for pos, data in patches:
+                self.f.seek(pos)
+                self.f.write(data)
+                if profile.enabled:
+                    self.countIO("bytes written", len(data))
+            self.f.seek(current)
+            self.patches = []
+
     def peek(self, n):
+        if self.view is not None:
+            return self.readAt(self.tell(), n)
         pos = self.tell()
         ret = self.read(n)
         self.seek(pos)
         return ret
 
     def writeLine(self, data):
-        self.f.write(data + "\n")
+        self.write(data + "\n")
 
     def setEndian(self, little):
         self.endian = "<" if little else ">"
@@ -98,102 +321,93 @@ class Stream(object):
         return struct.unpack(self.endian + "q", self.read(8))[0]
 
     def readLongAt(self, pos):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readLong()
-        self.seek(current)
-        return ret
+        return self.unpackAt(pos, "q")
 
     def readULong(self):
         return struct.unpack(self.endian + "Q", self.read(8))[0]
 
     def readULongAt(self, pos):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readULong()
-        self.seek(current)
-        return ret
+        return self.unpackAt(pos, "Q")
 
     def readInt(self):
         return struct.unpack(self.endian + "i", self.read(4))[0]
 
     def readIntAt(self, pos):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readInt()
-        self.seek(current)
-        return ret
+        return self.unpackAt(pos, "i")
 
     def readUInt(self):
         return struct.unpack(self.endian + "I", self.read(4))[0]
 
     def readUIntAt(self, pos):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readUInt()
-        self.seek(current)
-        return ret
+        return self.unpackAt(pos, "I")
 
     def readFloat(self):
         return struct.unpack(self.endian + "f", self.read(4))[0]
 
     def readFloatAt(self, pos):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readFloat()
-        self.seek(current)
-        return ret
+        return self.unpackAt(pos, "f")
 
     def readDouble(self):
         return struct.unpack(self.endian + "d", self.read(8))[0]
 
     def readDoubleAt(self, pos):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readDouble()
-        self.seek(current)
-        return ret
+        return self.unpackAt(pos, "d")
 
     def readShort(self):
         return struct.unpack(self.endian + "h", self.read(2))[0]
 
     def readShortAt(self, pos):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readShort()
-        self.seek(current)
-        return ret
+        return self.unpackAt(pos, "h")
 
     def readUShort(self):
         return struct.unpack(self.endian + "H", self.read(2))[0]
 
     def readUShortAt(self, pos):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readUShort()
-        self.seek(current)
-        return ret
+        return self.unpackAt(pos, "H")
 
     def readByte(self):
         return struct.unpack("B", self.read(1))[0]
 
     def readByteAt(self, pos):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readByte()
-        self.seek(current)
-        return ret
+        return self.unpackAt(pos, "B")
 
     def readSByte(self):
         return struct.unpack("b", self.read(1))[0]
 
     def readSByteAt(self, pos):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readSByte()
-        self.seek(current)
+        return self.unpackAt(pos, "b")
+
+    def unpackArray(self, typecode, data):
+        ret = array.array(typecode)
+        ret.frombytes(data[:len(data) - (len(data) % ret.itemsize)])
+        if ret.itemsize > 1 and (self.endian == "<") != (sys.byteorder == "little"):
+            ret.byteswap()
         return ret
 
+    def readArray(self, typecode, n):
+        return self.unpackArray(typecode, self.read(n * array.array(typecode).itemsize))
+
+    def readArrayAt(self, pos, typecode, n):
+        return self.unpackArray(typecode, self.readAt(pos, n * array.array(typecode).itemsize))
+
+    def readByteArray(self, n):
+        return self.readArray("B", n)
+
+    def readShortArray(self, n):
+        return self.readArray("h", n)
+
+    def readUShortArray(self, n):
+        return self.readArray("H", n)
+
+    def readIntArray(self, n):
+        return self.readArray("i", n)
+
+    def readUIntArray(self, n):
+        return self.readArray("I", n)
+
+    def readFloatArray(self, n):
+        return self.readArray("f", n)
+
     def readHalf(self, big=False):
         if self.half is None:
             self.half = self.readByte()
@@ -205,164 +419,166 @@ class Stream(object):
             self.half = None
             return ret
 
+    def readHalves(self, n, big=False):
+        ret = bytearray()
+        if n > 0 and self.half is not None:
+            ret.append(self.readHalf(big))
+            n -= 1
+        data = self.read((n + 1) // 2)
+        first = data.translate(highnibbles if big else lownibbles)
+        second = data.translate(lownibbles if big else highnibbles)
+        halves = bytearray(len(data) * 2)
+        halves[0::2] = first
+        halves[1::2] = second
+        if n % 2 == 1 and len(data) == (n + 1) // 2:
+            # Keep the last byte around for the next readHalf call
+            self.half = data[-1]
+            halves = halves[:-1]
+        ret += halves
+        return ret
+
     def readZeros(self, size):
         while self.tell() < size:
-            byte = self.readByte()
-            if byte != 0x00:
-                self.seek(-1, 1)
+            pos = self.tell()
+            data = self.read(min(size - pos, 0x1000))
+            if len(data) == 0:
+                raise struct.error("unpack requires a buffer of 1 bytes")
+            zeros = len(data) - len(data.lstrip(b"\x00"))
+            if zeros < len(data):
+                self.seek(pos + zeros)
                 break
 
     def readBytes(self, n, upper=False):
-        ret = ""
-        for i in range(n):
-            ret += toHex(self.readByte(), upper) + " "
-        return ret
+        data = self.read(n)
+        if len(data) < n:
+            raise struct.error("unpack requires a buffer of 1 bytes")
+        return "".join(("{:02X} " if upper else "{:02x} ").format(byte) for byte in data)
+
+    def unpackString(self, data, length):
+        if len(data) < length:
+            raise struct.error("unpack requires a buffer of 1 bytes")
+        # These control characters can be found in texture names, replace them with a space
+        return data.translate(stringtable, b"\x00").decode("latin-1")
 
     def readString(self, length):
-        ret = ""
-        for _ in range(length):
-            byte = self.readByte()
-            # These control characters can be found in texture names, replace them with a space
-            if byte == 0x82 or byte == 0x86:
-                byte = 0x20
-            if byte != 0:
-                ret += chr(byte)
-        return ret
+        return self.unpackString(self.read(length), length)
 
     def readStringAt(self, pos, length):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readString(length)
-        self.seek(current)
-        return ret
+        return self.unpackString(self.readAt(pos, length), length)
 
-    def readNullString(self):
-        ret = ""
+    def readNullBytes(self):
+        pos = self.tell()
+        if self.view is not None:
+            end = self.f.find(b"\x00", pos)
+            if end < 0:
+                self.seek(0, 2)
+                raise struct.error("unpack requires a buffer of 1 bytes")
+            self.seek(end + 1)
+            return self.f[pos:end]
+        ret = b""
         while True:
-            byte = self.readByte()
-            if byte == 0:
-                break
-            else:
-                ret += chr(byte)
-        return ret
+            chunk = self.read(0x100)
+            if len(chunk) == 0:
+                raise struct.error("unpack requires a buffer of 1 bytes")
+            end = chunk.find(b"\x00")
+            if end >= 0:
+                self.seek(pos + len(ret) + end + 1)
+                return ret + chunk[:end]
+            ret += chunk
+
+    def readNullBytesAt(self, pos):
+        if self.view is not None:
+            end = self.f.find(b"\x00", pos)
+            if end < 0:
+                raise struct.error("unpack requires a buffer of 1 bytes")
+            return self.f[pos:end]
+        if self.fd < 0:
+            current = self.tell()
+            self.seek(pos)
+            ret = self.readNullBytes()
+            self.seek(current)
+            return ret
+        ret = b""
+        while True:
+            chunk = os.pread(self.fd, 0x100, pos + len(ret))
+            if len(chunk) == 0:
+                raise struct.error("unpack requires a buffer of 1 bytes")
+            end = chunk.find(b"\x00")
+            if end >= 0:
+                return ret + chunk[:end]
+            ret += chunk
+
+    def readNullString(self):
+        return self.readNullBytes().decode("latin-1")
 
     def readNullStringAt(self, pos):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readNullString()
-        self.seek(current)
-        return ret
+        return self.readNullBytesAt(pos).decode("latin-1")
 
     def readEncodedString(self, encoding="utf-8"):
-        num = 0
-        pos = self.tell()
-        while True:
-            byte = self.readByte()
-            if byte == 0:
-                break
-            else:
-                num += 1
-        self.seek(pos)
-        ret = self.read(num).decode(encoding)
-        self.readByte()
-        return ret
+        return self.readNullBytes().decode(encoding)
 
     def readEncodedStringAt(self, pos, encoding="utf-8"):
-        current = self.tell()
-        self.seek(pos)
-        ret = self.readEncodedString(encoding)
-        self.seek(current)
-        return ret
+        return self.readNullBytesAt(pos).decode(encoding)
 
     def writeLong(self, num):
-        self.f.write(struct.pack(self.endian + "q", num))
+        self.write(struct.pack(self.endian + "q", num))
 
     def writeLongAt(self, pos, num):
-        current = self.tell()
-        self.seek(pos)
-        self.writeLong(num)
-        self.seek(current)
+        self.packAt(pos, "q", num)
 
     def writeULong(self, num):
-        self.f.write(struct.pack(self.endian + "Q", num))
+        self.write(struct.pack(self.endian + "Q", num))
 
     def writeULongAt(self, pos, num):
-        current = self.tell()
-        self.seek(pos)
-        self.writeULong(num)
-        self.seek(current)
+        self.packAt(pos, "Q", num)
 
     def writeInt(self, num):
-        self.f.write(struct.pack(self.endian + "i", num))
+        self.write(struct.pack(self.endian + "i", num))
 
     def writeIntAt(self, pos, num):
-        current = self.tell()
-        self.seek(pos)
-        self.writeInt(num)
-        self.seek(current)
+        self.packAt(pos, "i", num)
 
     def writeUInt(self, num):
-        self.f.write(struct.pack(self.endian + "I", num))
+        self.write(struct.pack(self.endian + "I", num))
 
     def writeUIntAt(self, pos, num):
-        current = self.tell()
-        self.seek(pos)
-        self.writeUInt(num)
-        self.seek(current)
+        self.packAt(pos, "I", num)
 
     def writeFloat(self, num):
-        self.f.write(struct.pack(self.endian + "f", num))
+        self.write(struct.pack(self.endian + "f", num))
 
     def writeFloatAt(self, pos, num):
-        current = self.tell()
-        self.seek(pos)
-        self.writeFloat(num)
-        self.seek(current)
+        self.packAt(pos, "f", num)
 
     def writeDouble(self, num):
-        self.f.write(struct.pack(self.endian + "d", num))
+        self.write(struct.pack(self.endian + "d", num))
 
     def writeDoubleAt(self, pos, num):
-        current = self.tell()
-        self.seek(pos)
-        self.writeDouble(num)
-        self.seek(current)
+        self.packAt(pos, "d", num)
 
     def writeShort(self, num):
-        self.f.write(struct.pack(self.endian + "h", num))
+        self.write(struct.pack(self.endian + "h", num))
 
     def writeShortAt(self, pos, num):
-        current = self.tell()
-        self.seek(pos)
-        self.writeShort(num)
-        self.seek(current)
+        self.packAt(pos, "h", num)
 
     def writeUShort(self, num):
-        self.f.write(struct.pack(self.endian + "H", num))
+        self.write(struct.pack(self.endian + "H", num))
 
     def writeUShortAt(self, pos, num):
-        current = self.tell()
-        self.seek(pos)
-        self.writeUShort(num)
-        self.seek(current)
+        self.packAt(pos, "H", num)
 
     def writeByte(self, num):
-        self.f.write(struct.pack("B", num))
+        self.write(struct.pack("B", num))
 
     def writeByteAt(self, pos, num):
-        current = self.tell()
-        self.seek(pos)
-        self.writeByte(num)
-        self.seek(current)
+        self.packAt(pos, "B", num)
 
     def writeSByte(self, num):
-        self.f.write(struct.pack("b", num))
+        self.write(struct.pack("b", num))
 
     def writeSByteAt(self, pos, num):
-        current = self.tell()
-        self.seek(pos)
-        self.writeSByte(num)
-        self.seek(current)
+        self.packAt(pos, "b", num)
 
     def writeHalf(self, num, little=True):
         if self.half is None:
@@ -374,18 +590,35 @@ class Stream(object):
                 self.writeByte((self.half << 4) | num)
             self.half = None
 
+    def writeHalves(self, data, little=True):
+        data = bytes(data).translate(lownibbles)
+        if len(data) > 0 and self.half is not None:
+            self.writeHalf(data[0], little)
+            data = data[1:]
+        if len(data) % 2 == 1:
+            self.half = data[-1]
+            data = data[:-1]
+        first = data[0::2]
+        second = data[1::2]
+        if not little:
+            first, second = second, first
+        # Nibbles never carry over into the next byte, so the whole run can be packed with a single shift
+        packed = (int.from_bytes(second, "little") << 4) | int.from_bytes(first, "little")
+        self.write(packed.to_bytes(len(first), "little"))
+
     def writeString(self, str):
-        self.f.write(str.encode("ascii"))
+        self.write(str.encode("ascii"))
 
     def writeZero(self, num):
         self.writeBytes(0x0, num)
 
     def writeBytes(self, byte, num):
         if num > 0:
-            for i in range(num):
-                self.writeByte(byte)
+            self.write(bytes([byte]) * num)
 
     def truncate(self):
+        if self.buffered:
+            self.flush()
         self.f.truncate()
 
 
@@ -410,10 +643,16 @@ if hasClick:
 
     @click.group(invoke_without_command=True)
     @click.option("--log", is_flag=True, default=False)
+    @click.option("--profile", "profiling", is_flag=True, default=False, help="Write stage timings and counters to profile.json.")
+    @click.option("--profile-memory", is_flag=True, default=False, help="Also track peak memory usage while profiling.")
+    @click.option("--profile-trace", is_flag=True, default=False, help="Also write a Chrome trace to profile_trace.json.")
     @click.option("--gui", is_flag=True, default=False)
     @click.pass_context
-    def cli(ctx, log, gui):
+    def cli(ctx, log, profiling, profile_memory, profile_trace, gui):
         setupFileLogging(log)
+        if profiling or profile_memory or profile_trace:
+            profile.enable(profile_memory)
+            ctx.call_on_close(lambda: profile.dump("profile.json", "profile_trace.json" if profile_trace else ""))
         if ctx.invoked_subcommand is None:
             multi = typing.cast(click.MultiCommand, ctx.command)
             ctx.invoke(multi.get_command(ctx, "main"), gui=gui)
@@ -490,25 +729,40 @@ def setupFileLogging(log):
     logging.basicConfig(handlers=[filehandler], format="[%(levelname)s] %(message)s", level=logging.DEBUG if log else logging.INFO)
 
 
+class Lazy(object):
+    # Log argument that is only computed when the message is formatted, for example Lazy(toHex, pos)
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def formatMessage(messages):
+    return " ".join(str(x) for x in messages)
+
+
 def logMessage(*messages):
-    message = " ".join(str(x) for x in messages)
+    message = formatMessage(messages)
     logging.info(message)
     if hasTqdm and sys.stdout is not None:
         tqdm.write(message)
 
 
 def logDebug(*messages):
-    message = " ".join(str(x) for x in messages)
-    logging.debug(message)
+    # Skip formatting entirely when debug logging is disabled
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug(formatMessage(messages))
 
 
 def logWarning(*messages):
-    message = " ".join(str(x) for x in messages)
-    logging.debug("[WARNING] " + message)
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug("[WARNING] " + formatMessage(messages))
 
 
 def logError(*messages):
-    message = " ".join(str(x) for x in messages)
+    message = formatMessage(messages)
     logging.error(message)
     if hasTqdm and sys.stdout is not None:
         tqdm.write("[ERROR] " + message)
@@ -531,12 +785,31 @@ def showProgress(iterable):
     if hasTqdm:
         if hasGUI:
             from .gui import tqdm_gui
-            return tqdm_gui(iterable=iterable)
+            iterable = tqdm_gui(iterable=iterable)
         else:
-            return tqdm(iterable=iterable)
+            iterable = tqdm(iterable=iterable)
+    if profile.enabled:
+        return profile.countItems(iterable, "files processed")
     return iterable
 
 
+def runThreaded(func, items, workers=1):
+    if workers <= 1:
+        return [func(item) for item in items]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items))
+
+
+def runProcesses(func, items, workers=1):
+    # func and items must be picklable
+    if workers <= 1:
+        return [func(item) for item in items]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items))
+
+
 # Strings
 def toHex(byte, upper=False):
     hexstr = hex(byte)[2:]
@@ -577,7 +850,44 @@ def loadTable(tablefile):
                     table[linesplit[0]] = linesplit[1]
 
 
+class PointerShiftMap:
+    # Cumulative pointer shifts, a pointer is moved by the sum of the diffs at offsets lower than it
+    def __init__(self, pointerdiff={}):
+        self.diffs = dict(pointerdiff)
+        self.offsets = []
+        self.shifts = [0]
+        self.dirty = True
+
+    def add(self, offset, diff):
+        self.diffs[offset] = self.diffs.get(offset, 0) + diff
+        self.dirty = True
+
+    def update(self):
+        self.offsets = sorted(self.diffs)
+        self.shifts = [0]
+        for offset in self.offsets:
+            self.shifts.append(self.shifts[-1] + self.diffs[offset])
+        self.dirty = False
+
+    def shift(self, pointer):
+        if self.dirty:
+            self.update()
+        return pointer + self.shifts[bisect.bisect_left(self.offsets, pointer)]
+
+    def shiftMany(self, pointers):
+        if self.dirty:
+            self.update()
+        offsets = self.offsets
+        shifts = self.shifts
+        ret = [pointer + shifts[bisect.bisect_left(offsets, pointer)] for pointer in pointers]
+        if isinstance(pointers, array.array):
+            return array.array(pointers.typecode, ret)
+        return ret
+
+
 def shiftPointer(pointer, pointerdiff):
+    if isinstance(pointerdiff, PointerShiftMap):
+        return pointerdiff.shift(pointer)
     newpointer = pointer
     for k, v in pointerdiff.items():
         if k < pointer:
@@ -587,34 +897,74 @@ def shiftPointer(pointer, pointerdiff):
     return newpointer
 
 
+# Shift-JIS lead and trail byte tables
+# Based on https://www.lemoda.net/c/detect-shift-jis/
+sjislead = bytes([1 if (x >= 0x81 and x <= 0x84) or (x >= 0x87 and x <= 0x9f) or (x >= 0xe0 and x <= 0xef) else 0 for x in range(256)])
+sjistrail = bytes([1 if x >= 0x40 and x <= 0xfc else 0 for x in range(256)])
+sjispair = b"[" + re.escape(bytes([x for x in range(256) if sjislead[x]])) + b"][" + re.escape(bytes([x for x in range(256) if sjistrail[x]])) + b"]"
+# Runs that readEncodedString and detectEncodedString decode without UNK codes
+sjisreadrun = re.compile(b"(?:\\x0a|[\\x01-\\x09\\x0b-\\x7f](?!\\x01)|" + sjispair + b")*")
+sjisdetectrun = re.compile(b"(?:[\\x0a\\x1c-\\x7e]|" + sjispair + b")*")
+sjisencodings = {}
+
+
 def checkShiftJIS(first, second):
-    # Based on https://www.lemoda.net/c/detect-shift-jis/
-    status = False
-    if (first >= 0x81 and first <= 0x84) or (first >= 0x87 and first <= 0x9f):
-        if second >= 0x40 and second <= 0xfc:
-            status = True
-    elif first >= 0xe0 and first <= 0xef:
-        if second >= 0x40 and second <= 0xfc:
-            status = True
-    return status
+    if first < 0 or first > 0xff or second < 0 or second > 0xff:
+        return False
+    return sjislead[first] == 1 and sjistrail[second] == 1
+
+
+def readShiftJISRun(f, pattern, encoding, startascii=None):
+    # Decode the whole null-terminated run at once if it matches the pattern
+    # Otherwise, return None and leave the position unchanged
+    if encoding not in sjisencodings:
+        try:
+            sjisencodings[encoding] = codecs.lookup(encoding).name in ["shift_jis", "cp932"]
+        except LookupError:
+            sjisencodings[encoding] = False
+    if not sjisencodings[encoding]:
+        return None
+    pos = f.tell()
+    try:
+        data = f.readNullBytes()
+    except struct.error:
+        f.seek(pos)
+        return None
+    # ASCII characters can only start a detected string if they're in startascii
+    if startascii is not None and len(data) > 0 and data[0] >= 28 and data[0] <= 126 and data[0] not in startascii:
+        pass
+    elif pattern.fullmatch(data) is not None:
+        try:
+            return data.decode(encoding).replace("\n", "|").replace("〜", "～")
+        except UnicodeDecodeError:
+            pass
+    f.seek(pos)
+    return None
+
+
+def getSectionFiles(file, filestart=1, fileend=10):
+    if os.path.isfile(file.format("")):
+        return [file.format("")]
+    files = []
+    for i in range(filestart, fileend + 1):
+        sectionfile = file.format(str(i))
+        if not os.path.isfile(sectionfile):
+            break
+        files.append(sectionfile)
+    return files
 
 
 def openSection(file, filestart=1, fileend=10):
-    if not os.path.isfile(file.format("")):
-        if os.path.isfile(file.format(str(filestart))):
-            section = StringIO()
-            for i in range(filestart, fileend + 1):
-                sectionfile = file.format(str(i))
-                if os.path.isfile(sectionfile):
-                    with codecs.open(sectionfile, "r", "utf-8") as f:
-                        section.write(f.read())
-                else:
-                    break
-            return section
-        else:
-            return None
-    else:
-        return codecs.open(file.format(""), "r", "utf-8")
+    files = getSectionFiles(file, filestart, fileend)
+    if len(files) == 0:
+        return None
+    if files[0] == file.format(""):
+        return codecs.open(files[0], "r", "utf-8")
+    section = StringIO()
+    for sectionfile in files:
+        with codecs.open(sectionfile, "r", "utf-8") as f:
+            section.write(f.read())
+    return section
 
 
 def getSectionNames(f):
@@ -662,15 +1012,87 @@ def getSection(f, title, comment="#", fixchars=[], justone=True, inorder=False):
     return ret
 
 
-def getSections(file, comment="#", fixchars=[], inorder=False):
+def readSections(f, comment="#", fixchars=[], inorder=False, titled=False):
+    # Read all the sections in one pass, lines before the first !FILE: title go in the "" section
+    # With titled, the "" section is only kept if the file also has an empty !FILE: title
     sections = {}
+    section = sections[""] = [] if inorder else {}
+    emptytitle = False
+    try:
+        f.seek(0)
+        for line in f:
+            line = line.rstrip("\r\n").replace("\ufeff", "")
+            if line.startswith("!FILE:"):
+                title = line[6:].split("#")[0]
+                if title == "":
+                    emptytitle = True
+                if title not in sections:
+                    sections[title] = [] if inorder else {}
+                section = sections[title]
+            elif line.startswith(comment) and inorder:
+                section.append({"name": line, "value": ""})
+            elif line.find("=") > 0:
+                name, value = line.split("=", 1)
+                value = value.split(comment)[0]
+                for fixchar in fixchars:
+                    value = value.replace(fixchar[0], fixchar[1])
+                if inorder:
+                    section.append({"name": name, "value": value})
+                elif name in section:
+                    section[name].append(value)
+                else:
+                    section[name] = [value]
+    except UnicodeDecodeError:
+        pass
+    if not emptytitle and (titled or len(sections[""]) == 0):
+        del sections[""]
+    return sections
+
+
+def getSections(file, comment="#", fixchars=[], inorder=False):
     with codecs.open(file, "r", "utf-8") as wsb:
-        files = getSectionNames(wsb)
-        for file in files:
-            sections[file] = getSection(wsb, file, comment, fixchars, inorder=inorder)
+        return readSections(wsb, comment, fixchars, inorder, True)
+
+
+def openSections(files, comment="#", fixchars=[]):
+    # Read and merge the sections of multiple files, translations for the same title and string are appended in order
+    if isinstance(files, str):
+        files = [files]
+    sections = {}
+    for file in files:
+        f = openSection(file)
+        if f is None:
+            continue
+        with f:
+            filesections = readSections(f, comment, fixchars)
+        for title, section in filesections.items():
+            if title not in sections:
+                sections[title] = section
+                continue
+            for name, values in section.items():
+                sections[title].setdefault(name, []).extend(values)
     return sections
 
 
+sectioncache = {}
+
+
+def getCachedSection(files, title, comment="#", fixchars=[]):
+    # The files are only parsed again if they changed, a copy is returned since callers pop translations from it
+    if isinstance(files, str):
+        files = [files]
+    key = (tuple(files), comment, tuple(tuple(x) for x in fixchars))
+    stamp = []
+    for file in files:
+        for sectionfile in getSectionFiles(file):
+            stat = os.stat(sectionfile)
+            stamp.append((sectionfile, stat.st_mtime_ns, stat.st_size))
+    if key not in sectioncache or sectioncache[key][0] != stamp:
+        sectioncache[key] = (stamp, openSections(files, comment, fixchars))
+    section = sectioncache[key][1].get(title, {})
+    return {name: list(values) for name, values in section.items()}
+
+
 def getSectionPercentage(section, chartot=0, transtot=0):
     for s in section.keys():
         strlen = len(s)
@@ -684,6 +1106,24 @@ def getSectionPercentage(section, chartot=0, transtot=0):
 def mergeSections(file1, file2, output, comment="#", fixchars=[]):
     sections1 = getSections(file1, comment, fixchars, inorder=True)
     sections2 = getSections(file2, comment, fixchars)
+    # Collect the different translations of each string to report conflicts
+    found = {}
+    for section in sections1.values():
+        for v in section:
+            if not v["name"].startswith(comment):
+                values = found.setdefault(v["name"], [])
+                if v["value"] != "" and v["value"] not in values:
+                    values.append(v["value"])
+    # Index the translations by string, the first section of file2 where the first translation is set is used
+    translations = {}
+    for section in sections2.values():
+        for s, values in section.items():
+            if s not in translations and values[0] != "":
+                translations[s] = values[0]
+            if s in found:
+                for value in values:
+                    if value != "" and value not in found[s]:
+                        found[s].append(value)
     with codecs.open(output, "w", "utf-8") as out:
         for section in sections1.keys():
             out.write("!FILE:" + section + "\n")
@@ -694,29 +1134,95 @@ def mergeSections(file1, file2, output, comment="#", fixchars=[]):
                     continue
                 sectionstr = v["value"]
                 if sectionstr == "":
-                    for section2 in sections2.keys():
-                        if s in sections2[section2] and sections2[section2][s][0] != "":
-                            sectionstr = sections2[section2][s][0]
-                            break
+                    sectionstr = translations.get(s, "")
                 out.write(s + "=" + sectionstr + "\n")
+    conflicts = {s: values for s, values in found.items() if len(values) > 1}
+    if len(conflicts) > 0:
+        logMessage("Found", len(conflicts), "strings with conflicting translations")
+        for s, values in conflicts.items():
+            logDebug("Conflicting translations for", s, values)
+    return conflicts
 
 
 class TranslationFile:
-    def __init__(self, path=""):
+    def __init__(self, path="", filenames=None):
         self.files = {}
+        # Per file indexes of the trans-units by id and by source text
+        self.units = {}
         self.lookup = {}
+        self.lookupcomments = None
         self.chartot = 0
         self.transtot = 0
+        # Set when a unit is added or changed, save skips writing back an unchanged file
+        self.path = path
+        self.dirty = False
+        # Files loaded with a filter are read-only, since the other files are not kept
+        self.filenames = filenames
         if path == "":
             self.root = ET.Element("xliff")
             self.root.set("version", "1.2")
             self.root.set("xmlns", "urn:oasis:names:tc:xliff:document:1.2")
         else:
             ET.register_namespace("", "urn:oasis:names:tc:xliff:document:1.2")
-            tree = ET.parse(path)
-            self.root = tree.getroot()
-            for file in self.root:
-                self.files[file.attrib["original"]] = file
+            if filenames is None:
+                self.root = ET.parse(path).getroot()
+                for file in self.root:
+                    self.files[file.attrib["original"]] = file
+            else:
+                # Stream the file, dropping the units of the files that are not needed as soon as they're parsed
+                self.root = None
+                skip = False
+                parent = None
+                for event, elem in ET.iterparse(path, events=("start", "end")):
+                    tag = elem.tag.rpartition("}")[2]
+                    if event == "start":
+                        if self.root is None:
+                            self.root = elem
+                        elif tag == "file":
+                            skip = elem.attrib["original"] not in filenames
+                        elif tag == "body":
+                            parent = elem
+                    elif skip and tag == "trans-unit":
+                        parent.remove(elem)
+                    elif tag == "file":
+                        if skip:
+                            self.root.remove(elem)
+                        else:
+                            self.files[elem.attrib["original"]] = elem
+
+    def getUnits(self, filename):
+        # Index the units of a file on first use
+        if filename not in self.units:
+            self.units[filename] = ({}, {})
+            for unit in self.files[filename][0]:
+                self.indexUnit(filename, unit)
+        return self.units[filename]
+
+    def indexUnit(self, filename, unit):
+        ids, texts = self.units[filename]
+        ids.setdefault(unit.attrib["id"], []).append(unit)
+        texts.setdefault(unit[0].text, []).append(unit)
+
+    def setTarget(self, unit, text):
+        # Set the translation of a unit as given, keeping the preloaded lookup updated
+        if text != unit[1].text:
+            self.dirty = True
+        translated = unit[1].text is not None and unit[1].text != ""
+        unit[1].text = text
+        if self.lookupcomments is None:
+            return
+        source = unit[0].text
+        if translated != (text is not None and text != ""):
+            self.transtot += len(source) if not translated else -len(source)
+        self.updateLookup(source)
+
+    def updateLookup(self, source):
+        # The last translated unit with this source text is used, comments are only removed from the lookup copy
+        self.lookup.pop(source, None)
+        for filename in self.files:
+            for unit in self.getUnits(filename)[1].get(source, []):
+                if unit[1].text is not None and unit[1].text != "":
+                    self.lookup[source] = unit[1].text.split(self.lookupcomments)[0]
 
     def mergeSection(self, path, filename="", section="", comments="#", fixchars=[]):
         with codecs.open(path, "r", "utf-8") as bin:
@@ -731,9 +1237,11 @@ class TranslationFile:
                     newcheck = mergesection[check][0]
                     if len(mergesection[check]) > 1:
                         mergesection[check].pop(0)
-                    unit[1].text = newcheck
-                    unit[1].set("state", "translated")
-                    unit.set("approved", "no")
+                    self.setTarget(unit, newcheck)
+                    if unit[1].get("state") != "translated" or unit.get("approved") != "no":
+                        unit[1].set("state", "translated")
+                        unit.set("approved", "no")
+                        self.dirty = True
     
     def addEntry(self, text, filename, offset, translation="", comment=""):
         # Check if we need to add a new file
@@ -744,9 +1252,11 @@ class TranslationFile:
             file.set("target-language", "en")
             ET.SubElement(file, "body")
             self.files[filename] = file
+            self.units[filename] = ({}, {})
         else:
             file = self.files[filename]
         # Add the new entry
+        self.dirty = True
         unit = ET.SubElement(file[0], "trans-unit", {"id": str(offset), "xml:space": "preserve"})
         source = ET.SubElement(unit, "source")
         source.text = text
@@ -756,8 +1266,22 @@ class TranslationFile:
         if comment != "":
             note = ET.SubElement(unit, "note")
             note.text = comment
+        if filename in self.units:
+            self.indexUnit(filename, unit)
+        if self.lookupcomments is not None:
+            self.offlookup[int(offset)] = text
+            self.chartot += len(text)
+            if translation != "":
+                target.text = None
+                self.setTarget(unit, translation)
+        if hasattr(self, "offsets"):
+            self.offsets.setdefault(filename, []).append(int(offset))
 
     def preloadLookup(self, comments="#"):
+        # Once loaded, the lookup is kept updated by addEntry, setEntry and mergeSection instead of being a snapshot,
+        # so getEntry also finds translations set after this call
+        if self.lookupcomments == comments:
+            return
         self.lookup = {}
         self.offlookup = {}
         self.chartot = 0
@@ -769,8 +1293,10 @@ class TranslationFile:
                 if unit[1].text is not None and unit[1].text != "":
                     if comments in unit[1].text:
                         unit[1].text = unit[1].text.split(comments)[0]
+                        self.dirty = True
                     self.lookup[unit[0].text] = unit[1].text
                     self.transtot += len(unit[0].text)
+        self.lookupcomments = comments
 
     def preloadOffsets(self):
         self.offsets = {}
@@ -780,15 +1306,15 @@ class TranslationFile:
                 self.offsets[file].append(int(unit.attrib["id"]))
 
     def getEntry(self, text, filename, offset):
-        stroffset = str(offset)
         if filename in self.files:
+            ids, texts = self.getUnits(filename)
             # Try to match offset
-            for unit in self.files[filename][0]:
-                if unit.attrib["id"] == stroffset and unit[1].text is not None and unit[1].text != "":
+            for unit in ids.get(str(offset), []):
+                if unit[1].text is not None and unit[1].text != "":
                     return unit[1].text
             # Try to match string
-            for unit in self.files[filename][0]:
-                if unit[0].text == text and unit[1].text is not None and unit[1].text != "":
+            for unit in texts.get(text, []):
+                if unit[1].text is not None and unit[1].text != "":
                     return unit[1].text
         # If nothing was found, run a search on the whole file
         if text in self.lookup:
@@ -796,17 +1322,16 @@ class TranslationFile:
         return ""
 
     def setEntry(self, text, filename, offset, newtext):
-        stroffset = str(offset)
         if filename in self.files:
+            ids, texts = self.getUnits(filename)
             # Try to match offset
-            for unit in self.files[filename][0]:
-                if unit.attrib["id"] == stroffset:
-                    unit[1].text = newtext
-                    return
+            units = ids.get(str(offset), [])
+            if len(units) > 0:
+                self.setTarget(units[0], newtext)
+                return
             # Try to match string
-            for unit in self.files[filename][0]:
-                if unit[0].text == text:
-                    unit[1].text = newtext
+            for unit in texts.get(text, []):
+                self.setTarget(unit, newtext)
 
     def hasFile(self, filename):
         return filename in self.files
@@ -817,27 +1342,80 @@ class TranslationFile:
         return (100 * self.transtot) / self.chartot
 
     def save(self, filename, dummy=False):
+        if self.filenames is not None:
+            logError("Can't save", filename, "since it was loaded with a file filter")
+            return
         if dummy:
             self.addEntry("dummy line", "dummy", 0, "dummy translation", "Ignore this")
+        # Skip writing if nothing changed since the file was loaded or saved
+        if not self.dirty and filename == self.path and os.path.isfile(filename):
+            return
         makeFolders(os.path.dirname(filename))
-        self._pretty_print(self.root)
-        xmlstr = ET.tostring(self.root, encoding="unicode", xml_declaration=True)
-        # Change this to match what Weblate does
-        xmlstr = xmlstr.replace("<target />", "<target/>") + "\n"
-        xmlstr = xmlstr.replace("<?xml version='1.0' encoding='utf-8'?>", "<?xml version=\"1.0\" encoding=\"UTF-8\"?>")
+        # Write the indented XML directly, matching what Weblate does
+        out = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"]
+        writeXMLElement(out, self.root)
+        out.append("\n")
         with codecs.open(filename, "w", "utf-8") as f:
-            f.write(xmlstr)
-
-    def _pretty_print(self, current, parent=None, index=-1, depth=0):
-        for i, node in enumerate(current):
-            self._pretty_print(node, current, i, depth + 1)
-        if parent is not None:
-            if index == 0:
-                parent.text = "\n" + ("  " * depth)
-            else:
-                parent[index - 1].tail = "\n" + ("  " * depth)
-            if index == len(parent) - 1:
-                current.tail = "\n" + ("  " * (depth - 1))
+            f.write("".join(out))
+        self.path = filename
+        self.dirty = False
+
+
+xmlnames = {}
+
+
+def escapeXML(text, attrib=False):
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if attrib:
+        if "\"" in text:
+            text = text.replace("\"", "&quot;")
+        if "\r" in text:
+            text = text.replace("\r", "&#13;")
+        if "\n" in text:
+            text = text.replace("\n", "&#10;")
+        if "\t" in text:
+            text = text.replace("\t", "&#09;")
+    return text
+
+
+def getXMLName(tag):
+    if tag in xmlnames:
+        return xmlnames[tag]
+    name = tag
+    if tag[0] == "{":
+        uri, name = tag[1:].split("}")
+        if uri == "http://www.w3.org/XML/1998/namespace":
+            name = "xml:" + name
+    xmlnames[tag] = name
+    return name
+
+
+def writeXMLElement(out, elem, depth=0):
+    # Writes an element and its children with two spaces of indentation per level
+    tag = getXMLName(elem.tag)
+    out.append("<" + tag)
+    if depth == 0 and elem.tag[0] == "{":
+        out.append(" xmlns=\"" + escapeXML(elem.tag[1:].split("}")[0], True) + "\"")
+    for key, value in elem.attrib.items():
+        out.append(" " + getXMLName(key) + "=\"" + escapeXML(value, True) + "\"")
+    if len(elem) > 0:
+        out.append(">")
+        indent = "\n" + "  " * (depth + 1)
+        for child in elem:
+            out.append(indent)
+            writeXMLElement(out, child, depth + 1)
+        out.append("\n" + "  " * depth + "</" + tag + ">")
+    elif elem.text:
+        out.append(">" + escapeXML(elem.text) + "</" + tag + ">")
+    elif tag == "target":
+        out.append("/>")
+    else:
+        out.append(" />")
 
 
 class FontGlyph:
@@ -923,6 +1501,9 @@ def centerLines(text, glyphs, width, codefunc=None, default=6, linebreak="|", ce
 
 
 def readEncodedString(f, encoding="shift_jis", upper=False):
+    sjis = readShiftJISRun(f, sjisreadrun, encoding)
+    if sjis is not None:
+        return sjis
     sjis = ""
     while True:
         b1 = f.readByte()
@@ -949,6 +1530,9 @@ def readEncodedString(f, encoding="shift_jis", upper=False):
 
 
 def detectEncodedString(f, encoding="shift_jis", startascii=[0x25], startenc=[], upper=False):
+    ret = readShiftJISRun(f, sjisdetectrun, encoding, startascii)
+    if ret is not None:
+        return ret
     ret = ""
     sjis = 0
     while True:
@@ -992,66 +1576,156 @@ def detectASCIIString(f, encoding="ascii", startascii=[]):
     return ret
 
 
+# UNK(xxxx) codes, ASCII runs and multibyte runs
+encodedtokens = re.compile(r"UNK\((..)(..).?|((?:(?!UNK\(....)[\x00-\x7f])+)|([^\x00-\x7f]+)", re.DOTALL)
+
+
 def writeEncodedString(f, s, maxlen=0, encoding="shift_jis", zerobytes=1):
     i = 0
-    x = 0
+    data = bytearray()
     s = s.replace("～", "〜")
-    while x < len(s):
-        c = s[x]
-        if c == "U" and x < len(s) - 4 and s[x:x+4] == "UNK(":
-            if maxlen > 0 and i+2 > maxlen:
+    for match in encodedtokens.finditer(s):
+        unk1, unk2, ascii, multi = match.groups()
+        if unk1 is not None:
+            if maxlen > 0 and i + 2 > maxlen:
+                f.write(bytes(data))
                 return -1
-            code = s[x+4] + s[x+5]
-            f.write(bytes.fromhex(code))
-            code = s[x+6] + s[x+7]
-            f.write(bytes.fromhex(code))
-            x += 8
+            data += bytes.fromhex(unk1) + bytes.fromhex(unk2)
             i += 2
-        elif c == "|":
-            if maxlen > 0 and i+1 > maxlen:
+        elif ascii is not None:
+            # Write what fits and stop if the run is too long
+            full = maxlen <= 0 or i + len(ascii) <= maxlen
+            if not full:
+                ascii = ascii[:maxlen - i]
+            data += ascii.replace("|", "\n").encode("ascii")
+            i += len(ascii)
+            if not full:
+                f.write(bytes(data))
                 return -1
-            f.writeByte(0x0a)
-            i += 1
-        elif ord(c) < 128:
-            if maxlen > 0 and i+1 > maxlen:
-                return -1
-            f.writeByte(ord(c))
-            i += 1
         else:
-            if maxlen > 0 and i+2 > maxlen:
+            # Multibyte characters always count as 2 bytes
+            full = maxlen <= 0 or i + len(multi) * 2 <= maxlen
+            if not full:
+                multi = multi[:(maxlen - i) // 2]
+            data += multi.encode(encoding)
+            i += len(multi) * 2
+            if not full:
+                f.write(bytes(data))
                 return -1
-            f.write(c.encode(encoding))
-            i += 2
-        x += 1
     if zerobytes > 0:
         if zerobytes > 1:
             if maxlen > 0 and i+1 > maxlen:
+                f.write(bytes(data))
                 return -1
             i += zerobytes - 1
-        f.writeZero(zerobytes)
+        data += bytes(zerobytes)
+    f.write(bytes(data))
     return i
 
 
-def extractBinaryStrings(infile, binranges, func=detectEncodedString, encoding="shift_jis"):
-    strings = []
-    positions = []
+def getStringScanner(func):
+    # Returns a compiled pattern matching the bytes a string detected by func can start with, or None if unknown
+    startascii = [0x25]
+    startenc = []
+    if isinstance(func, functools.partial) and len(func.args) == 0:
+        startascii = func.keywords.get("startascii", startascii)
+        startenc = func.keywords.get("startenc", startenc)
+        func = func.func
+    if func is detectASCIIString:
+        return re.compile(b"[\\x0a\\x1c-\\x7e]")
+    if func is not detectEncodedString:
+        return None
+    starts = [b"\\x0a", b"[\\x81-\\x84\\x87-\\x9f\\xe0-\\xef][\\x40-\\xfc]"]
+    starts += [re.escape(bytes([x])) for x in startascii if x >= 28 and x <= 126]
+    starts += [re.escape(bytes(x)) for x in startenc]
+    return re.compile(b"|".join(starts))
+
+
+def scanBinaryStrings(f, start, end, func=detectEncodedString, encoding="shift_jis"):
+    # Yields (pos, string) for every string found by func between start and end
+    # The detector only runs on offsets where the scanner finds a possible string start
+    scanner = getStringScanner(func)
+    data = None
+    if scanner is not None:
+        data = f.view if f.view is not None else f.readAt(0)
+    pos = start
+    while pos < end:
+        if data is not None:
+            match = scanner.search(data, pos, end + 1)
+            if match is None or match.start() >= end:
+                break
+            pos = match.start()
+        f.seek(pos)
+        check = func(f, encoding)
+        if check != "":
+            yield pos, check
+            pos = f.tell()
+        else:
+            pos += 1
+
+
+def scanBinaryChunk(chunk):
+    # Returns (pos, string, endpos) for the strings found in a chunk, run by findBinaryStrings workers
+    infile, start, end, func, encoding = chunk
+    ret = []
+    with Stream(infile, "mmap") as f:
+        for pos, check in scanBinaryStrings(f, start, end, func, encoding):
+            ret.append((pos, check, f.tell()))
+    return ret
+
+
+def getBinaryChunks(data, start, end, chunksize):
+    # Split a range after double 0x00 bytes, where a string can't continue past
+    chunks = []
+    while end - start > chunksize:
+        split = data.find(b"\x00\x00", start + chunksize, end)
+        if split < 0:
+            break
+        chunks.append((start, split + 2))
+        start = split + 2
+    chunks.append((start, end))
+    return chunks
+
+
+@profile.stage("common.findBinaryStrings", "extract")
+def findBinaryStrings(infile, binranges, func=detectEncodedString, encoding="shift_jis", workers=1):
+    # Returns a dict of string -> list of positions, in the order the strings were found
+    found = {}
     insize = os.path.getsize(infile)
-    with Stream(infile, "rb") as f:
-        for binrange in binranges:
-            f.seek(binrange[0])
-            while f.tell() < binrange[1] and f.tell() < insize - 2:
-                pos = f.tell()
-                check = func(f, encoding)
-                if check != "":
-                    if check not in strings:
-                        logDebug("Found string", check, "at", toHex(pos))
-                        strings.append(check)
-                        positions.append([pos])
-                    else:
-                        positions[strings.index(check)].append(pos)
-                    pos = f.tell() - 1
-                f.seek(pos + 1)
-    return strings, positions
+    if workers > 1:
+        try:
+            pickle.dumps(func)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            logWarning("String detector can't be sent to other processes, scanning with a single worker")
+            workers = 1
+    ranges = [[(binrange[0], min(binrange[1], insize - 2))] for binrange in binranges]
+    if workers > 1:
+        with Stream(infile, "mmap") as f:
+            data = f.f if f.view is not None else f.read()
+            ranges = [getBinaryChunks(data, start, end, max(0x10000, (end - start) // (workers * 4))) for [(start, end)] in ranges]
+    chunks = [chunk for chunks in ranges for chunk in chunks]
+    results = runProcesses(scanBinaryChunk, [(infile, chunk[0], chunk[1], func, encoding) for chunk in chunks], workers)
+    i = 0
+    for chunks in ranges:
+        pos = 0
+        for chunk in chunks:
+            result = results[i]
+            i += 1
+            if pos > chunk[0]:
+                # The previous string ran past the chunk start, scan again from its end
+                result = scanBinaryChunk((infile, pos, chunk[1], func, encoding))
+            for strpos, check, pos in result:
+                if check not in found:
+                    logDebug("Found string", check, "at", Lazy(toHex, strpos))
+                    found[check] = [strpos]
+                else:
+                    found[check].append(strpos)
+    return found
+
+
+def extractBinaryStrings(infile, binranges, func=detectEncodedString, encoding="shift_jis", workers=1):
+    found = findBinaryStrings(infile, binranges, func, encoding, workers)
+    return list(found.keys()), list(found.values())
 
 
 class BinaryPointer:
@@ -1061,14 +1735,335 @@ class BinaryPointer:
         self.str = str
 
 
-def repackBinaryStrings(section, infile, outfile, binranges, freeranges=None, readfunc=detectEncodedString, writefunc=writeEncodedString, encoding="shift_jis", pointerstart=0, injectstart=0, fallbackf=None, injectfallback=0, sectionname="bin", preformat=None, postformat=None):
+class PointerIndex:
+    # Offsets of the little endian 32-bit words in data with a value between start and end
+    def __init__(self, data, start=0, end=0x100000000, align=4):
+        self.offsets = {}
+        for shift in range(0, 4, align):
+            words = array.array("I")
+            words.frombytes(data[shift:shift + (len(data) - shift) // 4 * 4])
+            if sys.byteorder != "little":
+                words.byteswap()
+            for i in [i for i, word in enumerate(words) if word >= start and word < end]:
+                self.offsets.setdefault(words[i], []).append(shift + i * 4)
+        if align < 4:
+            for offsets in self.offsets.values():
+                offsets.sort()
+
+    def find(self, pointer):
+        # Skip overlapping matches like a bytes.find loop would
+        ret = []
+        for offset in self.offsets.get(pointer, []):
+            if len(ret) == 0 or offset >= ret[-1] + 4:
+                ret.append(offset)
+        return ret
+
+
+def reportBinaryPointers(infile, binranges, readfunc=detectEncodedString, encoding="shift_jis", pointerstart=0):
+    # Logs the aligned pointers that reference each string in binranges, returns a dict of string position -> pointer offsets
+    found = findBinaryStrings(infile, binranges, readfunc, encoding)
+    with Stream(infile, "mmap") as f:
+        pointers = PointerIndex(f.f if f.view is not None else f.read(), pointerstart, pointerstart + os.path.getsize(infile))
+    ret = {}
+    for check, positions in found.items():
+        for pos in positions:
+            ret[pos] = pointers.find(pointerstart + pos)
+            if len(ret[pos]) == 0:
+                logMessage("String", check, "at", toHex(pos), "has no pointers")
+            else:
+                logMessage("String", check, "at", toHex(pos), "pointed at", ", ".join(toHex(x) for x in ret[pos]))
+    return ret
+
+
+class FreeSpace:
+    # Free [start, end) ranges of a binary, sorted and coalesced, with best-fit allocation
+    # The optional third element of a range is the pointer base: True for injectstart, a number, or None for pointerstart
+    def __init__(self, ranges=[]):
+        self.starts = []
+        self.ranges = []
+        self.sizes = []
+        self.minrequest = -1
+        for freerange in ranges:
+            self.add(freerange[0], freerange[1], freerange[2] if len(freerange) > 2 else None)
+
+    def insertRange(self, i, freerange):
+        self.starts.insert(i, freerange[0])
+        self.ranges.insert(i, freerange)
+        bisect.insort(self.sizes, (freerange[1] - freerange[0], freerange[0]))
+
+    def removeRange(self, i):
+        freerange = self.ranges.pop(i)
+        self.starts.pop(i)
+        self.sizes.pop(bisect.bisect_left(self.sizes, (freerange[1] - freerange[0], freerange[0])))
+        return freerange
+
+    def sameBase(self, freerange, base):
+        return type(freerange[2]) == type(base) and freerange[2] == base
+
+    def add(self, start, end, base=None):
+        if end <= start:
+            return
+        i = bisect.bisect_left(self.starts, start)
+        if i > 0 and self.ranges[i - 1][1] >= start and self.sameBase(self.ranges[i - 1], base):
+            i -= 1
+            freerange = self.removeRange(i)
+            start = freerange[0]
+            end = max(end, freerange[1])
+        while i < len(self.ranges) and self.ranges[i][0] <= end and self.sameBase(self.ranges[i], base):
+            end = max(end, self.removeRange(i)[1])
+        self.insertRange(i, [start, end, base])
+
+    def remove(self, start, end):
+        i = max(0, bisect.bisect_right(self.starts, start) - 1)
+        while i < len(self.ranges) and self.ranges[i][0] < end:
+            freerange = self.ranges[i]
+            if freerange[1] <= start:
+                i += 1
+                continue
+            self.removeRange(i)
+            if freerange[0] < start:
+                self.insertRange(i, [freerange[0], start, freerange[2]])
+                i += 1
+            if freerange[1] > end:
+                self.insertRange(i, [end, freerange[1], freerange[2]])
+                i += 1
+
+    def find(self, size):
+        # Smallest range with room for size bytes and a terminator
+        if self.minrequest < 0 or size < self.minrequest:
+            self.minrequest = size
+        i = bisect.bisect_left(self.sizes, (size + 1, -1))
+        if i == len(self.sizes):
+            return None
+        return self.ranges[bisect.bisect_left(self.starts, self.sizes[i][1])]
+
+    def use(self, freerange, end):
+        # Mark the range as used up to end
+        self.removeRange(bisect.bisect_left(self.starts, freerange[0]))
+        if end < freerange[1]:
+            self.add(end, freerange[1], freerange[2])
+
+    def getReport(self):
+        free = sum(x[0] for x in self.sizes)
+        largest = self.sizes[-1][0] if len(self.sizes) > 0 else 0
+        wasted = sum(x[0] for x in self.sizes if x[0] <= self.minrequest)
+        fragmentation = 100 * (1 - largest / free) if free > 0 else 0
+        return "{0} bytes free in {1} ranges, largest {2}, fragmentation {3:.2f}%, {4} bytes too small to use".format(free, len(self.sizes), largest, fragmentation, wasted)
+
+
+def getFileStamp(file):
+    # Size and modification time, to check if a file changed without reading it
+    filestat = os.stat(file)
+    return [filestat.st_size, filestat.st_mtime_ns]
+
+
+def getFunctionName(func):
+    if func is None:
+        return ""
+    if isinstance(func, functools.partial):
+        return getFunctionName(func.func) + repr(func.args) + repr(sorted(func.keywords.items()))
+    return getattr(func, "__module__", "") + "." + getattr(func, "__qualname__", type(func).__name__)
+
+
+@profile.stage("common.repackBinaryStrings", "encode")
+def repackBinaryStrings(section, infile, outfile, binranges, freeranges=None, readfunc=detectEncodedString, writefunc=writeEncodedString, encoding="shift_jis", pointerstart=0, injectstart=0, fallbackf=None, injectfallback=0, sectionname="bin", preformat=None, postformat=None, tailmerge=False, manifest=""):
     insize = os.path.getsize(infile)
     notfound = []
-    with Stream(infile, "rb") as fi:
-        if freeranges is not None:
-            allbin = fi.read()
+    freespace = None
+    deferred = {}
+    # The strings found in the binary, as [pos, endpos, string, translation, relocation]
+    # The relocation is [pointer, offset, size, requested size] for strings written somewhere else, offset is -1 for the fallback file
+    entries = []
+    strslots = {}
+    pointers = None
+
+    def getTranslation(section, check, pos):
+        # Returns the string to write, or None if the string is not translated
+        pre = post = ""
+        if preformat != None:
+            check, pre, post = preformat(check)
+        if isinstance(section, TranslationFile):
+            newsjis = section.getEntry(check, sectionname, pos)
+        else:
+            newsjis = section[check][0] if check in section else ""
+            if newsjis != "":
+                if len(section[check]) > 1:
+                    section[check].pop(0)
+        if newsjis == "":
+            return None
+        if newsjis == "!":
+            newsjis = ""
+        if postformat != None:
+            newsjis = postformat(newsjis, pre, post)
+        return newsjis
+
+    def writeString(f, newsjis):
+        writefunc(f, newsjis, 0, encoding)
+        f.seek(-1, 1)
+        if f.readByte() != 0:
+            f.writeZero(1)
+
+    def writeInPlace(f, pos, endpos, newsjis):
+        # Write the string over the original one, returns False if it didn't fit
+        f.seek(pos)
+        newlen = writefunc(f, newsjis, endpos - pos + 1, encoding)
+        f.seek(-1, 1)
+        if f.readByte() != 0:
+            f.writeZero(1)
+        if newlen < 0:
+            return False
+        f.writeZero(endpos - f.tell())
+        return True
+
+    def getRequestSize(newsjis):
+        rangelen = 0
+        for c in newsjis:
+            rangelen += 1 if ord(c) < 256 else 2
+        return rangelen
+
+    def encodeString(newsjis):
+        with Stream() as f:
+            writeString(f, newsjis)
+            return f.readAt(0)
+
+    def placeString(newsjis, newsjislog, size):
+        # Write the string in a new portion of the rom, returns the new pointer or -1 if there's no room
+        range = freespace.find(size)
+        if range is None:
+            if injectfallback == 0:
+                return -1
+            logDebug("No room for the string", newsjislog, ", redirecting to fallback")
+            fallbackpos = fallbackf.tell()
+            writeString(fallbackf, newsjis)
+            strslots[newsjis] = [-1, fallbackf.tell() - fallbackpos, size]
+            return injectfallback + fallbackpos
+        logDebug("No room for the string", newsjislog, ", redirecting to", Lazy(toHex, range[0]))
+        fo.seek(range[0])
+        writeString(fo, newsjis)
+        strslots[newsjis] = [range[0], fo.tell() - range[0], size]
+        newpointer = range[0]
+        # For the injected range, add injectstart, otherwise add pointerstart
+        if range[2] is None:
+            newpointer += pointerstart
+        elif isinstance(range[2], bool):
+            newpointer += injectstart
+        else:
+            newpointer += int(range[2])
+        freespace.use(range, fo.tell())
+        return newpointer
+
+    def replacePointer(pos, newpointer, newsjislog):
+        # Search and replace the old pointer
+        nonlocal pointers
+        pointer = pointerstart + pos
+        if pointers is None:
+            # Index every byte offset, like searching the whole binary for the pointer would
+            pointers = PointerIndex(allbin, pointerstart, pointerstart + insize, 1)
+        logDebug("Searching for pointer", Lazy(toHex, pointer))
+        foundone = False
+        for index in pointers.find(pointer):
+            foundone = True
+            logDebug("Replaced pointer at", Lazy(toHex, pointerstart + index), "with", Lazy(toHex, newpointer))
+            fo.seek(index)
+            fo.writeUInt(newpointer)
+        if not foundone:
+            logWarning("Pointer", toHex(pointer), "->", toHex(newpointer), "not found for string", newsjislog)
+            notfound.append(BinaryPointer(pointer, newpointer, newsjislog))
+
+    def repackChanged(state):
+        # Apply only the changed translations on top of the previous output, returns False if a full repack is needed
+        changedsection = section if isinstance(section, TranslationFile) else {k: list(v) for k, v in section.items()}
+        strings = state["strings"]
+        relocated = [x for x in strings if x[4] is not None]
+        if any(x[4][1] < 0 for x in relocated):
+            # Strings in the fallback file need to be written again
+            return False
+        translations = [getTranslation(changedsection, x[2], x[0]) for x in strings]
+        changed = [i for i, x in enumerate(strings) if translations[i] != x[3]]
+        # Relocated strings and replaced pointers are written after the strings before them, a changed string can't overlap them
+        used = []
+        if len(changed) > 0 and len(relocated) > 0:
+            with Stream(infile, "mmap") as fi:
+                index = PointerIndex(fi.f if fi.view is not None else fi.read(), pointerstart, pointerstart + insize, 1)
+            used = [(x[4][1], x[4][1] + x[4][2]) for x in relocated]
+            used += [(y, y + 4) for x in relocated for y in index.find(pointerstart + x[0])]
+            used.sort()
+        usedstarts = [x[0] for x in used]
+        usedends = []
+        for x in used:
+            usedends.append(max(x[1], usedends[-1]) if len(usedends) > 0 else x[1])
+        order = sorted(range(len(strings)), key=lambda i: strings[i][0])
+        positions = [strings[i][0] for i in order]
+        patches = []
+        with Stream(manifest + ".bin", "rb") as fb:
+            for i in changed:
+                pos, endpos, check, _, relocation = strings[i]
+                newsjis = translations[i]
+                # Writing a string in place can also set the byte after endpos to 0
+                start, end = pos, min(endpos + 2, insize)
+                j = bisect.bisect_left(usedstarts, end)
+                if j > 0 and usedends[j - 1] > start:
+                    return False
+                if relocation is not None:
+                    # Reuse the previous relocation if it's not shared and the new string is placed the same way
+                    offset, size = relocation[1], relocation[2]
+                    if newsjis is None or tailmerge or any(x[3] == newsjis for x in relocated):
+                        return False
+                    if sum(1 for x in relocated if x[4][1] < offset + size and x[4][1] + x[4][2] > offset) > 1:
+                        return False
+                    encoded = encodeString(newsjis)
+                    if len(encoded) != size or getRequestSize(newsjis) != relocation[3]:
+                        return False
+                    patches.append((offset, encoded))
+                # Write again the strings around this one, in the same order as a full repack
+                k = bisect.bisect_left(positions, start)
+                replay = [order[x] for x in range(max(0, k - 1), len(order)) if positions[x] < end and strings[order[x]][1] + 2 > start]
+                lo = min(strings[x][0] for x in replay)
+                with Stream() as f:
+                    f.write(fb.readAt(lo, max(strings[x][1] + 2 for x in replay) - lo))
+                    for x in sorted(replay):
+                        if translations[x] is not None:
+                            fits = writeInPlace(f, strings[x][0] - lo, strings[x][1] - lo, translations[x])
+                            if x == i and fits != (relocation is None):
+                                return False
+                    patches.append((start, f.readAt(start - lo, end - start)))
+                logDebug("Rewriting changed string at", Lazy(toHex, pos))
+                strings[i][3] = newsjis
+        with Stream(outfile, "r+b") as fo:
+            for offset, data in patches:
+                fo.seek(offset)
+                fo.write(data)
+        for pointer in state["notfound"]:
+            notfound.append(BinaryPointer(pointer[0], pointer[1], pointer[2].encode("ascii")))
+        entries.extend(strings)
+        logMessage("Incremental repack, rewrote", len(changed), "strings")
+        return True
+
+    if manifest != "":
+        if isinstance(freeranges, FreeSpace):
+            options = [x[:3] for x in freeranges.ranges]
+        else:
+            options = [list(x) for x in freeranges] if freeranges is not None else None
+        options = repr([binranges, options, getFunctionName(readfunc), getFunctionName(writefunc), encoding, pointerstart, injectstart, injectfallback, sectionname, getFunctionName(preformat), getFunctionName(postformat), tailmerge])
+        state = readRepackManifest(manifest, outfile)
+        if state is not None and state["options"] == options and state["input"] == getFileStamp(infile) and repackChanged(state):
+            writeRepackManifest(manifest, infile, outfile, options, entries, notfound)
+            return notfound
+        if state is not None and state["input"] == getFileStamp(infile):
+            # The output is the previous repack, start again from the copy of the file it was repacked on
+            copyFile(manifest + ".bin", outfile)
+        else:
+            if state is not None:
+                copyFile(infile, outfile)
+            # Keep a copy of the file before repacking for the next incremental repacks
+            copyFile(outfile, manifest + ".bin")
+        logDebug("No valid manifest found, repacking all strings")
+
+    with Stream(infile, "mmap") as fi:
+        if freeranges is not None or injectfallback != 0:
+            allbin = fi.f if fi.view is not None else fi.read()
             strpointers = {}
-            freeranges = [list(x) for x in freeranges]
+            freespace = freeranges if isinstance(freeranges, FreeSpace) else FreeSpace(freeranges if freeranges is not None else [])
         with Stream(outfile, "r+b") as fo:
             for binrange in binranges:
                 fi.seek(binrange[0])
@@ -1076,104 +2071,95 @@ def repackBinaryStrings(section, infile, outfile, binranges, freeranges=None, re
                     pos = fi.tell()
                     check = readfunc(fi, encoding)
                     if check != "":
-                        pre = post = ""
-                        if preformat != None:
-                            check, pre, post = preformat(check)
-                        if isinstance(section, TranslationFile):
-                            newsjis = section.getEntry(check, sectionname, pos)
-                        else:
-                            newsjis = section[check][0] if check in section else ""
-                            if newsjis != "":
-                                if len(section[check]) > 1:
-                                    section[check].pop(0)
-                        if newsjis != "":
-                            if newsjis == "!":
-                                newsjis = ""
-                            if postformat != None:
-                                newsjis = postformat(newsjis, pre, post)
+                        newsjis = getTranslation(section, check, pos)
+                        entries.append([pos, fi.tell() - 1, check, newsjis, None])
+                        if newsjis is not None:
                             newsjislog = newsjis.encode("ascii", "ignore")
-                            logDebug("Replacing string at", toHex(pos), "with", newsjislog)
-                            fo.seek(pos)
+                            logDebug("Replacing string at", Lazy(toHex, pos), "with", newsjislog)
                             endpos = fi.tell() - 1
-                            newlen = writefunc(fo, newsjis, endpos - pos + 1, encoding)
-                            fo.seek(-1, 1)
-                            if fo.readByte() != 0:
-                                fo.writeZero(1)
-                            if newlen < 0:
-                                if (freeranges is None and injectfallback == 0) or pointerstart == 0:
+                            if not writeInPlace(fo, pos, endpos, newsjis):
+                                if freespace is None or pointerstart == 0:
                                     logError("String", newsjislog, "is too long.")
+                                elif tailmerge:
+                                    # Placed after all the strings are known
+                                    deferred.setdefault(newsjis, []).append((pos, endpos, newsjislog, len(entries) - 1))
                                 else:
-                                    # Add this to the freeranges
-                                    freeranges.append([pos, endpos])
-                                    logDebug("Adding new freerange", toHex(pos), toHex(endpos))
-                                    range = None
-                                    rangelen = 0
-                                    for c in newsjis:
-                                        rangelen += 1 if ord(c) < 256 else 2
-                                    for freerange in freeranges:
-                                        if freerange[1] - freerange[0] > rangelen:
-                                            range = freerange
-                                            break
-                                    if range is None and newsjis not in strpointers and injectfallback == 0:
+                                    # Add this to the free space
+                                    freespace.add(pos, endpos + 1)
+                                    logDebug("Adding new freerange", Lazy(toHex, pos), Lazy(toHex, endpos))
+                                    if newsjis in strpointers:
+                                        newpointer = strpointers[newsjis]
+                                    else:
+                                        newpointer = placeString(newsjis, newsjislog, getRequestSize(newsjis))
+                                    if newpointer < 0:
                                         logError("No more room! Skipping", newsjislog, "...")
-                                        freeranges.pop()
+                                        freespace.remove(pos, endpos + 1)
                                     else:
-                                        # Write the string in a new portion of the rom
-                                        if newsjis in strpointers:
-                                            newpointer = strpointers[newsjis]
-                                        elif range is None:
-                                            logDebug("No room for the string", newsjislog, ", redirecting to fallback")
-                                            fallbackpos = fallbackf.tell()
-                                            writefunc(fallbackf, newsjis, 0, encoding)
-                                            fallbackf.seek(-1, 1)
-                                            if fallbackf.readByte() != 0:
-                                                fallbackf.writeZero(1)
-                                            newpointer = injectfallback + fallbackpos
-                                            strpointers[newsjis] = newpointer
-                                        else:
-                                            logDebug("No room for the string", newsjislog, ", redirecting to", toHex(range[0]))
-                                            fo.seek(range[0])
-                                            writefunc(fo, newsjis, 0, encoding)
-                                            fo.seek(-1, 1)
-                                            if fo.readByte() != 0:
-                                                fo.writeZero(1)
-                                            newpointer = range[0]
-                                            # For the injected range, add injectstart, otherwise add pointerstart
-                                            if (len(range) == 3):
-                                                if isinstance(range[2], bool):
-                                                    newpointer += injectstart
-                                                else:
-                                                    newpointer += int(range[2])
-                                            else:
-                                                newpointer += pointerstart
-                                            range[0] = fo.tell()
-                                            strpointers[newsjis] = newpointer
-                                        # Search and replace the old pointer
-                                        pointer = pointerstart + pos
-                                        pointersearch = struct.pack("<I", pointer)
-                                        index = 0
-                                        logDebug("Searching for pointer", toHex(pointer))
-                                        foundone = False
-                                        while index < len(allbin):
-                                            index = allbin.find(pointersearch, index)
-                                            if index < 0:
-                                                break
-                                            foundone = True
-                                            logDebug("Replaced pointer at", toHex(pointerstart + index), "with", toHex(newpointer))
-                                            fo.seek(index)
-                                            fo.writeUInt(newpointer)
-                                            index += 4
-                                        if not foundone:
-                                            logWarning("Pointer", toHex(pointer), "->", toHex(newpointer), "not found for string", newsjislog)
-                                            # freeranges.pop()
-                                            notfound.append(BinaryPointer(pointer, newpointer, newsjislog))
-                            else:
-                                fo.writeZero(endpos - fo.tell())
+                                        strpointers[newsjis] = newpointer
+                                        entries[-1][4] = [newpointer] + strslots[newsjis]
+                                        replacePointer(pos, newpointer, newsjislog)
                         pos = fi.tell() - 1
                     fi.seek(pos + 1)
+            if len(deferred) > 0:
+                # Sort by reversed encoded string, so a string that is the suffix of another one comes right after it
+                encoded = {}
+                for newsjis in deferred:
+                    encoded[newsjis] = encodeString(newsjis)
+                previous = None
+                for newsjis in sorted(deferred, key=lambda x: encoded[x][::-1], reverse=True):
+                    strings = deferred[newsjis]
+                    newsjislog = strings[0][2]
+                    for pos, endpos, _, _ in strings:
+                        freespace.add(pos, endpos + 1)
+                    if previous in strpointers and encoded[previous].endswith(encoded[newsjis]):
+                        diff = len(encoded[previous]) - len(encoded[newsjis])
+                        newpointer = strpointers[previous] + diff
+                        strslots[newsjis] = [strslots[previous][0] + diff if strslots[previous][0] >= 0 else -1, len(encoded[newsjis]), len(encoded[newsjis]) - 1]
+                        logDebug("Merging string", newsjislog, "into", Lazy(toHex, newpointer))
+                    else:
+                        newpointer = placeString(newsjis, newsjislog, len(encoded[newsjis]) - 1)
+                    if newpointer < 0:
+                        logError("No more room! Skipping", newsjislog, "...")
+                        for pos, endpos, _, _ in strings:
+                            freespace.remove(pos, endpos + 1)
+                    else:
+                        strpointers[newsjis] = newpointer
+                        for pos, endpos, _, i in strings:
+                            entries[i][4] = [newpointer] + strslots[newsjis]
+                            replacePointer(pos, newpointer, newsjislog)
+                    previous = newsjis
+        if freespace is not None and freespace.minrequest >= 0:
+            logMessage("Free space left:", freespace.getReport())
+    if manifest != "":
+        writeRepackManifest(manifest, infile, outfile, options, entries, notfound)
     return notfound
 
 
+def readRepackManifest(manifest, outfile):
+    # Returns the manifest if the output wasn't modified since the repack that wrote it
+    try:
+        with open(manifest, "r") as f:
+            state = json.load(f)
+        if state["output"] == getFileStamp(outfile) and os.path.isfile(manifest + ".bin"):
+            return state
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def writeRepackManifest(manifest, infile, outfile, options, entries, notfound):
+    # The manifest is saved next to manifest + ".bin", a copy of the output before the strings were repacked
+    state = {
+        "options": options,
+        "input": getFileStamp(infile),
+        "output": getFileStamp(outfile),
+        "notfound": [[x.old, x.new, x.str.decode("ascii")] for x in notfound],
+        "strings": entries,
+    }
+    with open(manifest, "w") as f:
+        f.write(json.dumps(state))
+
+
 # Folders
 def makeFolder(folder, clear=True):
     if clear:
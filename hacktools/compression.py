@@ -19,9 +19,7 @@ def getBits(n, f, blen, fbuf):
 
 
 def decompressHuffman(rawdata, decomplength, numbits=8, little=True):
-    with common.Stream() as data:
-        data.write(rawdata)
-        data.seek(0)
+    with common.Stream.fromBuffer(rawdata) as data:
         with common.Stream() as out:
             treesize = data.readByte()
             treeroot = data.readByte()
@@ -1,6 +1,6 @@
 import os
 from enum import IntEnum
-from hacktools import common, cmp_cri
+from hacktools import common, cmp_cri, profile
 
 
 class CPK:
@@ -192,7 +192,8 @@ class UTFRow:
         self.position = 0
 
 
-def extract(file, outfolder, guessextension=None):
+@profile.stage("cpk.extract", "extract")
+def extract(file, outfolder, guessextension=None, workers=1):
     common.logDebug("Processing", file, "...")
     common.makeFolder(outfolder)
     cpk = readCPK(file)
@@ -202,27 +203,27 @@ def extract(file, outfolder, guessextension=None):
     if len(cpk.filetable) == 0:
         common.logError("No files in CPK filetable")
         return
-    with common.Stream(file, "rb") as f:
-        for entry in cpk.filetable:
-            if entry.filetype != "FILE":
-                continue
+    with common.Stream(file, "mmap") as f:
+        def extractEntry(entry):
             folder, filename = entry.getFolderFile(outfolder)
-            f.seek(entry.fileoffset)
-            data = f.read(entry.filesize)
-            f.seek(entry.fileoffset)
-            checkcomp = f.readString(8)
-            if checkcomp == "CRILAYLA":
+            # The view is only written out while the file is mapped, guessextension and the decompressor get bytes
+            data = f.readViewAt(entry.fileoffset, entry.filesize)
+            if data[:8] == b"CRILAYLA":
                 extractsize = entry.extractsize if entry.extractsize != 0 else entry.filesize
                 if extractsize != 0:
-                    data = cmp_cri.decompressCRILAYLA(data)
+                    data = cmp_cri.decompressCRILAYLA(bytes(data))
             if guessextension is not None:
+                data = bytes(data)
                 filename = guessextension(data, entry, filename)
             if not os.path.isdir(folder):
                 common.makeFolders(folder)
             with common.Stream(folder + filename, "wb") as fout:
                 fout.write(data)
+        # Entries are read with positional reads, so the same handle can be shared between threads
+        common.runThreaded(extractEntry, [x for x in cpk.filetable if x.filetype == "FILE"], workers)
 
 
+@profile.stage("cpk.repack", "repack")
 def repack(file, outfile, infolder, outfolder, nocmp=False):
     common.logDebug("Processing", file, "...")
     cpk = readCPK(file)
@@ -237,7 +238,7 @@ def repack(file, outfile, infolder, outfolder, nocmp=False):
     for subfile in common.getFiles(infolder):
         nameext = os.path.splitext(subfile)
         idtoext[nameext[0]] = nameext[1]
-    with common.Stream(outfile, "wb") as fout:
+    with common.Stream(outfile, "wb", buffered=True) as fout:
         with common.Stream(file, "rb") as fin:
             idnewdata = {}
             # Copy the file up to the ContentOffset
@@ -334,6 +335,7 @@ def repack(file, outfile, infolder, outfolder, nocmp=False):
                 fout.write(utfpacket)
 
 
+@profile.stage("cpk.readCPK", "parse")
 def readCPK(file):
     with common.Stream(file, "rb") as f:
         magic = f.readString(4)
@@ -468,9 +470,7 @@ def readITOC(f, cpk, tocoffset, contentoffset, align):
     sizetable = {}
     csizetable = {}
     if datal is not None:
-        data = common.Stream(little=False).__enter__()
-        data.write(datal)
-        data.seek(0)
+        data = common.Stream.fromBuffer(bytearray(datal), False)
         files.utfdatal = readUTF(data, -1, True)
         for i in range(files.utfdatal.numrows):
             id, _, _ = files.utfdatal.getColumnDataType(i, "ID")
@@ -481,9 +481,7 @@ def readITOC(f, cpk, tocoffset, contentoffset, align):
             if csize is not None:
                 csizetable[id] = (csize, csizepos, csizetype)
     if datah is not None:
-        data = common.Stream(little=False).__enter__()
-        data.write(datah)
-        data.seek(0)
+        data = common.Stream.fromBuffer(bytearray(datah), False)
         files.utfdatah = readUTF(data, -1, True)
         for i in range(files.utfdatah.numrows):
             id, _, _ = files.utfdatah.getColumnDataType(i, "ID")
@@ -535,15 +533,15 @@ def readUTFData(f):
     unk1 = f.readInt()
     utfsize = f.readLong()
     # common.logDebug("readUTFData unk1", common.toHex(unk1), "size", common.toHex(utfsize))
-    utfpacket = f.read(utfsize)
+    utfpacket = bytearray(utfsize)
+    del utfpacket[f.readInto(utfpacket):]
     encrypted = False
     if utfpacket[:4].decode("ascii", "ignore") != "@UTF":
-        utfpacket = decryptUTF(utfpacket)
+        utfpacket = bytearray(decryptUTF(utfpacket))
         encrypted = True
     f.setEndian(False)
-    packetstream = common.Stream(little=False).__enter__()
-    packetstream.write(utfpacket)
-    packetstream.seek(0)
+    # The packet is updated in place when repacking, so wrap the bytearray itself
+    packetstream = common.Stream.fromBuffer(utfpacket, False)
     return packetstream, utfsize, encrypted
 
 
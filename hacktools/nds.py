@@ -2,10 +2,11 @@ import codecs
 from enum import IntFlag
 import os
 import struct
-from hacktools import common, compression, cmp_lzss, cmp_misc
+from hacktools import common, compression, cmp_lzss, cmp_misc, profile
 
 
-def extractRom(romfile, extractfolder, workfolder=""):
+@profile.stage("nds.extractRom", "extract")
+def extractRom(romfile, extractfolder, workfolder="", workers=1):
     try:
         import ndspy.rom
     except ImportError:
@@ -16,12 +17,13 @@ def extractRom(romfile, extractfolder, workfolder=""):
     datafolder = extractfolder + "data/"
     rom = ndspy.rom.NintendoDSRom.fromFile(romfile)
     common.makeFolder(datafolder)
-    for i,file in enumerate(rom.files):
+    def extractFile(i):
         filepath = rom.filenames.filenameOf(i)
         if filepath is not None:
             common.makeFolders(datafolder + os.path.dirname(filepath))
             with common.Stream(datafolder + filepath, "wb") as f:
-                f.write(file)
+                f.write(rom.files[i])
+    common.runThreaded(extractFile, range(len(rom.files)), workers)
     with common.Stream(extractfolder + "banner.bin", "wb") as f:
         f.write(rom.iconBanner)
     with common.Stream(extractfolder + "header.bin", "wb") as f:
@@ -49,6 +51,7 @@ def extractRom(romfile, extractfolder, workfolder=""):
     common.logMessage("Done!")
 
 
+@profile.stage("nds.repackRom", "repack")
 def repackRom(romfile, rompatch, workfolder, patchfile=""):
     try:
         import ndspy.rom
@@ -109,50 +112,54 @@ def getHeaderID(file):
 
 
 # Binary-related functions
-def extractBIN(binrange, readfunc=common.detectEncodedString, encoding="shift_jis", binin="data/extract/arm9.bin", binfile="data/bin_output.txt", writepos=False, writedupes=False, sectionname="bin"):
+@profile.stage("nds.extractBIN", "extract")
+def extractBIN(binrange, readfunc=common.detectEncodedString, encoding="shift_jis", binin="data/extract/arm9.bin", binfile="data/bin_output.txt", writepos=False, writedupes=False, sectionname="bin", workers=1):
     common.logMessage("Extracting BIN to", binfile, "...")
     if type(binrange) == tuple:
         binrange = [binrange]
-    strings, positions = common.extractBinaryStrings(binin, binrange, readfunc, encoding)
+    found = common.findBinaryStrings(binin, binrange, readfunc, encoding, workers)
     if binfile.endswith(".txt"):
         with codecs.open(binfile, "w", "utf-8") as out:
-            for i in range(len(strings)):
+            for string, positions in found.items():
                 if writepos:
                     allpositions = []
-                    for strpos in positions[i]:
+                    for strpos in positions:
                         allpositions.append(common.toHex(strpos))
                     out.write(str(allpositions) + "!")
-                for j in range(1 if writedupes is False else len(positions[i])):
-                    out.write(strings[i] + "=\n")
+                for j in range(1 if writedupes is False else len(positions)):
+                    out.write(string + "=\n")
     else:
         t = common.TranslationFile()
-        for i in range(len(strings)):
-            for j in range(1 if writedupes is False else len(positions[i])):
-                t.addEntry(strings[i], sectionname, positions[i][j])
+        for string, positions in found.items():
+            for j in range(1 if writedupes is False else len(positions)):
+                t.addEntry(string, sectionname, positions[j])
         t.save(binfile, True)
-    common.logMessage("Done! Extracted", len(strings), "lines")
+    common.logMessage("Done! Extracted", len(found), "lines")
 
 
+@profile.stage("nds.repackBIN", "repack")
 def repackBIN(binrange, freeranges=[], readfunc=common.detectEncodedString, writefunc=common.writeEncodedString, encoding="shift_jis", comments="#",
-              binin="data/extract/arm9.bin", binout="data/repack/arm9.bin", binfile="data/bin_input.txt", fixchars=[], pointerstart=0x02000000, injectstart=0x02000000, fallbackf=None, injectfallback=0, nocopy=False, sectionname="bin", preformat=None, postformat=None):
+              binin="data/extract/arm9.bin", binout="data/repack/arm9.bin", binfile="data/bin_input.txt", fixchars=[], pointerstart=0x02000000, injectstart=0x02000000, fallbackf=None, injectfallback=0, nocopy=False, sectionname="bin", preformat=None, postformat=None, tailmerge=False, incremental=False, reportpointers=False):
     if not os.path.isfile(binfile):
         common.logError("Input file", binfile, "not found")
         return False
 
-    if not nocopy:
+    # The previous output is updated in place if it has a valid manifest
+    if not nocopy and (not incremental or common.readRepackManifest(binout + ".manifest", binout) is None):
         common.copyFile(binin, binout)
     common.logMessage("Repacking BIN from", binfile, "...")
     section = {}
     if binfile.endswith(".txt"):
-        with codecs.open(binfile, "r", "utf-8") as bin:
-            section = common.getSection(bin, "", comments, fixchars=fixchars)
-            chartot, transtot = common.getSectionPercentage(section)
+        section = common.getCachedSection(binfile, "", comments, fixchars)
+        chartot, transtot = common.getSectionPercentage(section)
     else:
         section = common.TranslationFile(binfile)
         section.preloadLookup(comments)
     if type(binrange) == tuple:
         binrange = [binrange]
-    notfound = common.repackBinaryStrings(section, binin, binout, binrange, freeranges, readfunc, writefunc, encoding, pointerstart, injectstart, fallbackf, injectfallback, sectionname, preformat, postformat)
+    if reportpointers:
+        common.reportBinaryPointers(binin, binrange, readfunc, encoding, pointerstart)
+    notfound = common.repackBinaryStrings(section, binin, binout, binrange, freeranges, readfunc, writefunc, encoding, pointerstart, injectstart, fallbackf, injectfallback, sectionname, preformat, postformat, tailmerge, binout + ".manifest" if incremental else "")
     for pointer in notfound:
         common.logError("Pointer", common.toHex(pointer.old), "->", common.toHex(pointer.new), "not found for string", pointer.str)
     if binfile.endswith(".txt"):
@@ -225,7 +232,7 @@ def expandBIN(binin, binout, headerin, headerout, newlengths, injectpos):
             size = fin.readUIntAt(copytablestart + 4)
             bsssize = fin.readUIntAt(copytablestart + 8)
             copytablestart += 12
-            common.logDebug("  start", common.toHex(start), "size", common.toHex(size), "bsssize", common.toHex(bsssize))
+            common.logDebug("  start", common.Lazy(common.toHex, start), "size", common.Lazy(common.toHex, size), "bsssize", common.Lazy(common.toHex, bsssize))
             sections.append(BINSection(fin, start, size, datastart, bsssize))
             datastart += size
     # Write the new extended arm9.bin
@@ -237,7 +244,7 @@ def expandBIN(binin, binout, headerin, headerout, newlengths, injectpos):
         datastart = f.tell()
         for i in range(1, len(sections)):
             sections[i].offset = f.tell()
-            common.logDebug("Section", i, "offset:", common.toHex(f.tell()))
+            common.logDebug("Section", i, "offset:", common.Lazy(common.toHex, f.tell()))
             f.write(sections[i].data)
         # Write the new copytable
         copytablestart = f.tell()
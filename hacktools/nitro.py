@@ -3,11 +3,11 @@ import os
 import shlex
 import shutil
 import subprocess
-import struct
-from hacktools import common
+from hacktools import common, profile
 
 
 # Generic extract/repack functions
+@profile.stage("nitro.extractNSBMD", "extract")
 def extractNSBMD(infolder, outfolder, extension=".nsbmd", readfunc=None):
     common.makeFolder(outfolder)
     common.logMessage("Extracting NSBMD to", outfolder, "...")
@@ -25,6 +25,7 @@ def extractNSBMD(infolder, outfolder, extension=".nsbmd", readfunc=None):
     common.logMessage("Done! Extracted", len(files), "files")
 
 
+@profile.stage("nitro.repackNSBMD", "repack")
 def repackNSBMD(workfolder, infolder, outfolder, extension=".nsbmd", readfunc=None, writefunc=None):
     common.logMessage("Repacking NSBMD from", workfolder, "...")
     files = common.getFiles(infolder, extension)
@@ -47,6 +48,7 @@ def repackNSBMD(workfolder, infolder, outfolder, extension=".nsbmd", readfunc=No
     common.logMessage("Done!")
 
 
+@profile.stage("nitro.extractIMG", "extract")
 def extractIMG(infolder, outfolder, extensions=".NCGR", readfunc=None):
     common.makeFolder(outfolder)
     common.logMessage("Extracting IMG to", outfolder, "...")
@@ -73,6 +75,7 @@ def extractIMG(infolder, outfolder, extensions=".NCGR", readfunc=None):
     common.logMessage("Done! Extracted", len(files), "files")
 
 
+@profile.stage("nitro.repackIMG", "repack")
 def repackIMG(workfolder, infolder, outfolder, extensions=".NCGR", readfunc=None, writefunc=None, clean=False):
     common.logMessage("Repacking IMG from", workfolder, "...")
     files = common.getFiles(infolder, extensions)
@@ -169,6 +172,7 @@ class FontPAMC:
         self.nextoffset = 0
 
 
+@profile.stage("nitro.readNFTR", "parse")
 def readNFTR(file, generateglyphs=False, encoding="shift_jis"):
     nftr = FontNFTR()
     with common.Stream(file, "rb") as f:
@@ -316,6 +320,7 @@ class NARCFile:
         self.fullname = ""
 
 
+@profile.stage("nitro.readNARC", "parse")
 def readNARC(narcfile):
     common.logDebug("Reading", narcfile)
     narc = NARC()
@@ -362,24 +367,24 @@ def readNARC(narcfile):
     return narc
 
 
-def extractNARCFile(narcfile, outfolder):
+def extractNARCFile(narcfile, outfolder, workers=1):
     narc = readNARC(narcfile)
     if narc is None:
         return
-    extractNARC(narcfile, outfolder, narc)
+    extractNARC(narcfile, outfolder, narc, workers)
 
 
-def extractNARC(narcfile, outfolder, narc):
+@profile.stage("nitro.extractNARC", "extract")
+def extractNARC(narcfile, outfolder, narc, workers=1):
     common.logDebug("Extracting", narcfile, "to", outfolder)
     if not outfolder.endswith("/"):
         outfolder = outfolder + "/"
     common.makeFolder(outfolder)
-    with common.Stream(narcfile, "rb") as f:
-        for i in range(len(narc.files)):
-            file = narc.files[i]
-            f.seek(file.start)
+    with common.Stream(narcfile, "mmap") as f:
+        def extractFile(file):
             with common.Stream(outfolder + file.fullname, "wb") as fout:
-                fout.write(f.read(file.size))
+                fout.write(f.readViewAt(file.start, file.size))
+        common.runThreaded(extractFile, narc.files, workers)
 
 
 def repackNARCFile(narcfilein, narcfileout, infolder):
@@ -389,12 +394,12 @@ def repackNARCFile(narcfilein, narcfileout, infolder):
     repackNARC(narcfilein, narcfileout, infolder, narc)
 
 
+@profile.stage("nitro.repackNARC", "repack")
 def repackNARC(narcfilein, narcfileout, infolder, narc):
     common.logDebug("Repacking", narcfileout, "from", infolder)
     with common.Stream(narcfilein, "rb") as fin:
-        with common.Stream(narcfileout, "wb") as f:
+        with common.Stream(narcfileout, "wb", buffered=True) as f:
             f.write(fin.read(narc.gmif + 8))
-            filepos = f.tell()
             for i in range(len(narc.files)):
                 file = narc.files[i]
                 # Read file data
@@ -406,24 +411,20 @@ def repackNARC(narcfilein, narcfileout, infolder, narc):
                     with common.Stream(filepath, "rb") as subf:
                         filedata = subf.read()
                 # Write it in the archive
-                f.seek(filepos)
                 filestart = f.tell()
                 f.write(filedata)
                 fileend = f.tell()
                 # Pad with 0s
                 if f.tell() % 4 > 0:
                     f.writeZero(f.tell() % 4)
-                filepos = f.tell()
                 # Update the pointers
-                f.seek(narc.btaf + 12 + i * 8)
-                f.writeUInt(filestart - narc.gmif - 8)
-                f.writeUInt(fileend - narc.gmif - 8)
+                f.writeUIntAt(narc.btaf + 12 + i * 8, filestart - narc.gmif - 8)
+                f.writeUIntAt(narc.btaf + 16 + i * 8, fileend - narc.gmif - 8)
+            filepos = f.tell()
             # Write the new GMIF section size
-            f.seek(narc.gmif + 4)
-            f.writeUInt(filepos - narc.gmif)
+            f.writeUIntAt(narc.gmif + 4, filepos - narc.gmif)
             # Write the new NARC size
-            f.seek(8)
-            f.writeUInt(filepos)
+            f.writeUIntAt(8, filepos)
 
 
 # Graphics
@@ -533,6 +534,7 @@ def readNitroGraphic(palettefile, tilefile, mapfile, cellfile, ignorepalindex=Fa
     return palettes, ncgr, nscr, ncer, width, height
 
 
+@profile.stage("nitro.readNCLR", "parse")
 def readNCLR(nclrfile, ignoreindex=False):
     palettes = []
     with common.Stream(nclrfile, "rb") as f:
@@ -554,9 +556,7 @@ def readNCLR(nclrfile, ignoreindex=False):
         # Read palettes
         f.seek(0x18 + offset)
         for i in range(pallen // (colornum * 2)):
-            palette = []
-            for j in range(colornum):
-                palette.append(common.readPalette(f.readUShort()))
+            palette = [common.readPalette(x) for x in f.readUShortArray(colornum)]
             palettes.append(palette)
         # Read index
         if sections == 2 and not ignoreindex:
@@ -572,6 +572,7 @@ def readNCLR(nclrfile, ignoreindex=False):
     return indexedpalettes
 
 
+@profile.stage("nitro.readNCGR", "parse")
 def readNCGR(ncgrfile):
     ncgr = NCGR()
     with common.Stream(ncgrfile, "rb") as f:
@@ -609,6 +610,7 @@ def readNCGRTiles(ncgr, tiledata):
         ncgr.tiles.append(singletile)
 
 
+@profile.stage("nitro.readNSCR", "parse")
 def readNSCR(nscrfile):
     nscr = NSCR()
     with common.Stream(nscrfile, "rb") as f:
@@ -618,10 +620,8 @@ def readNSCR(nscrfile):
         f.seek(4, 1)
         nscr.maplen = f.readUInt()
         nscr.mapoffset = f.tell()
-        mapdata = f.read(nscr.maplen)
         common.logDebug(vars(nscr))
-        for i in range(0, len(mapdata), 2):
-            data = struct.unpack("<h", mapdata[i:i+2])[0]
+        for data in f.readShortArray(nscr.maplen // 2):
             submap = readMapData(data)
             nscr.maps.append(submap)
     common.logDebug("Loaded", len(nscr.maps), "maps")
@@ -669,6 +669,7 @@ def getNCERCellSize(shape, size):
     return cellsize
 
 
+@profile.stage("nitro.readNCER", "parse")
 def readNCER(ncerfile, ignoredupes=False):
     ncer = NCER()
     with common.Stream(ncerfile, "rb") as f:
@@ -837,6 +838,7 @@ def tileToPixels(pixels, width, ncgr, tile, xflip, yflip, i, j, palette, pali, u
     return pixels
 
 
+@profile.stage("nitro.drawNCER", "render")
 def drawNCER(outfile, ncer, ncgr, palettes, usetransp=True, layered=False):
     try:
         from PIL import Image
@@ -925,6 +927,7 @@ def drawNCER(outfile, ncer, ncgr, palettes, usetransp=True, layered=False):
     img.save(outfile, "PNG")
 
 
+@profile.stage("nitro.drawNCGR", "render")
 def drawNCGR(outfile, nscr, ncgr, palettes, width, height, usetransp=True):
     try:
         from PIL import Image
@@ -989,6 +992,7 @@ def writeNCGRTile(f, pixels, width, ncgr, i, j, palette):
             writeNCGRData(f, ncgr.bpp, index1, index2)
 
 
+@profile.stage("nitro.writeNCGR", "encode")
 def writeNCGR(file, ncgr, infile, palettes, width=-1, height=-1):
     try:
         from PIL import Image
@@ -1008,6 +1012,7 @@ def writeNCGR(file, ncgr, infile, palettes, width=-1, height=-1):
                 writeNCGRTile(f, pixels, width, ncgr, i, j, palettes[0])
 
 
+@profile.stage("nitro.writeNSCR", "encode")
 def writeNSCR(file, ncgr, nscr, infile, palettes, width=-1, height=-1, skipfirst=False):
     try:
         from PIL import Image
@@ -1048,6 +1053,7 @@ def writeMappedNSCR(file, mapfile, ncgr, nscr, infile, palettes, width=-1, heigh
     writeMultiMappedNSCR(file, [mapfile], ncgr, [nscr], [infile], palettes, width, height, transptile, writelen, useoldpal)
 
 
+@profile.stage("nitro.writeMultiMappedNSCR", "encode")
 def writeMultiMappedNSCR(file, mapfiles, ncgr, nscrs, infiles, palettes, width=-1, height=-1, transptile=False, writelen=True, useoldpal=False):
     try:
         from PIL import Image
@@ -1126,6 +1132,7 @@ def searchTile(tile, tiles, tilesize=8):
     return -1, False, False
 
 
+@profile.stage("nitro.writeNCER", "encode")
 def writeNCER(file, ncerfile, ncgr, ncer, infile, palettes, width=0, height=0, appendTiles=False, checkRepeat=True, writelen=True, fixtransp=False, checkalpha=False, zerotransp=True):
     try:
         from PIL import Image
@@ -1390,11 +1397,10 @@ def readTEX0(nsbmd, f, zerotransp=False):
     # Traverse palettes
     for pal in nsbmd.palettes:
         f.seek(pal.offset)
-        for i in range(pal.size // 2):
-            palcolor = common.readPalette(f.readShort())
-            if i == 0 and zerotransp:
-                palcolor = (palcolor[0], palcolor[1], palcolor[2], 0)
-            pal.data.append(palcolor)
+        pal.data = [common.readPalette(x) for x in f.readShortArray(pal.size // 2)]
+        if len(pal.data) > 0 and zerotransp:
+            palcolor = pal.data[0]
+            pal.data[0] = (palcolor[0], palcolor[1], palcolor[2], 0)
     # Traverse texture
     spdataoffset = nsbmd.spdataoffset
     for texi in range(len(nsbmd.textures)):
@@ -1402,19 +1408,18 @@ def readTEX0(nsbmd, f, zerotransp=False):
         if tex.format == 5:
             r = tex.size >> 1
             f.seek(spdataoffset)
-            for i in range(r // 2):
-                tex.spdata.append(f.readUShort())
+            tex.spdata = f.readUShortArray(r // 2)
             spdataoffset += r
         # Export texture
         f.seek(tex.offset)
         if tex.format == 5:
-            for i in range(tex.size // 4):
-                tex.data.append(f.readUInt())
+            tex.data = f.readUIntArray(tex.size // 4)
         else:
             tex.data = f.read(tex.size)
     return nsbmd
 
 
+@profile.stage("nitro.readNSBMD", "parse")
 def readNSBMD(nsbmdfile, zerotransp=False):
     nsbmd = NSBMD()
     with common.Stream(nsbmdfile, "rb") as f:
@@ -1435,6 +1440,7 @@ def readNSBMD(nsbmdfile, zerotransp=False):
         return readTEX0(nsbmd, f, zerotransp)
 
 
+@profile.stage("nitro.readNSBTX", "parse")
 def readNSBTX(nsbmdfile, zerotransp=False):
     nsbmd = NSBMD()
     with common.Stream(nsbmdfile, "rb") as f:
@@ -1446,6 +1452,7 @@ def readNSBTX(nsbmdfile, zerotransp=False):
         return readTEX0(nsbmd, f, zerotransp)
 
 
+@profile.stage("nitro.drawNSBMD", "render")
 def drawNSBMD(file, nsbmd, texi):
     try:
         from PIL import Image
@@ -1571,6 +1578,7 @@ def drawNSBMD(file, nsbmd, texi):
     img.save(file, "PNG")
 
 
+@profile.stage("nitro.writeNSBMD", "encode")
 def writeNSBMD(file, nsbmd, texi, infile, fixtransp=False, checkalpha=False, zerotransp=True, backwards=False):
     try:
         from PIL import Image
@@ -1711,9 +1719,7 @@ def readNBFP(ntfpfile, bpp=8):
             pallen = 32
         colornum = pallen // 2
         for i in range(size // pallen):
-            palette = []
-            for j in range(colornum):
-                palette.append(common.readPalette(f.readUShort()))
+            palette = [common.readPalette(x) for x in f.readUShortArray(colornum)]
             palettes.append(palette)
         indexedpalettes = {i: palettes[i] for i in range(0, len(palettes))}
     common.logDebug("Loaded", len(indexedpalettes), "palettes")
@@ -1758,9 +1764,8 @@ def readNBFC(ntftfile, palette, lineal, bpp=0):
 def readNBFS(nscrfile):
     nbfs = NSCR()
     with common.Stream(nscrfile, "rb") as f:
-        mapdata = f.read()
-    for i in range(0, len(mapdata), 2):
-        data = struct.unpack("<h", mapdata[i:i+2])[0]
+        mapdata = f.readShortArray(os.path.getsize(nscrfile) // 2)
+    for data in mapdata:
         map = readMapData(data)
         nbfs.maps.append(map)
     maplen = len(nbfs.maps)
@@ -0,0 +1,142 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+enabled = False
+trackmemory = False
+starttime = 0
+events = []
+counters = {}
+
+
+def enable(memory=False):
+    global enabled, trackmemory, starttime
+    reset()
+    enabled = True
+    trackmemory = memory
+    starttime = time.perf_counter()
+    if trackmemory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global enabled, trackmemory
+    if trackmemory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    enabled = False
+    trackmemory = False
+
+
+def reset():
+    events.clear()
+    counters.clear()
+
+
+def count(name, n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+
+def countFile(mode):
+    # Files opened with "+" are counted as opened for writing
+    if mode == "mmap" or ("r" in mode and "+" not in mode):
+        count("files opened for reading")
+    else:
+        count("files opened for writing")
+
+
+def countItems(iterable, name="items processed"):
+    for item in iterable:
+        count(name)
+        yield item
+
+
+class stage(object):
+    # Times a stage, usable both as a context manager and as a decorator
+    def __init__(self, name, category="stage"):
+        self.name = name
+        self.category = category
+        self.starts = threading.local()
+
+    def __enter__(self):
+        if enabled:
+            if not hasattr(self.starts, "stack"):
+                self.starts.stack = []
+            self.starts.stack.append(time.perf_counter())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not enabled or not getattr(self.starts, "stack", None):
+            return
+        start = self.starts.stack.pop()
+        event = {
+            "name": self.name,
+            "cat": self.category,
+            "start": start - starttime,
+            "duration": time.perf_counter() - start,
+            "thread": threading.get_ident(),
+        }
+        if trackmemory:
+            event["peak"] = tracemalloc.get_traced_memory()[1]
+        events.append(event)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def getResults():
+    stages = {}
+    for event in events:
+        if event["name"] not in stages:
+            stages[event["name"]] = {"category": event["cat"], "calls": 0, "total": 0.0, "max": 0.0}
+        result = stages[event["name"]]
+        result["calls"] += 1
+        result["total"] += event["duration"]
+        result["max"] = max(result["max"], event["duration"])
+    results = {
+        "total": time.perf_counter() - starttime,
+        "stages": stages,
+        "counters": dict(counters),
+    }
+    if trackmemory and tracemalloc.is_tracing():
+        results["peak"] = tracemalloc.get_traced_memory()[1]
+    return results
+
+
+def getTrace():
+    # Chrome trace-event format, can be opened in chrome://tracing or Perfetto
+    pid = os.getpid()
+    trace = []
+    for event in events:
+        traceevent = {
+            "name": event["name"],
+            "cat": event["cat"],
+            "ph": "X",
+            "ts": event["start"] * 1000000,
+            "dur": event["duration"] * 1000000,
+            "pid": pid,
+            "tid": event["thread"],
+        }
+        if "peak" in event:
+            traceevent["args"] = {"peak": event["peak"]}
+        trace.append(traceevent)
+    for name, value in counters.items():
+        trace.append({"name": name, "ph": "C", "ts": (time.perf_counter() - starttime) * 1000000, "pid": pid, "args": {name: value}})
+    return {"traceEvents": trace}
+
+
+def dump(file="profile.json", tracefile=""):
+    with open(file, "w") as f:
+        json.dump(getResults(), f, indent=2)
+    if tracefile != "":
+        with open(tracefile, "w") as f:
+            json.dump(getTrace(), f)
@@ -4,9 +4,10 @@ import json
 import math
 import os
 import struct
-from hacktools import common
+from hacktools import common, profile
 
 
+@profile.stage("psp.extractIso", "extract")
 def extractIso(isofile, extractfolder, workfolder="", fixfilename=False):
     try:
         import pycdlib
@@ -31,6 +32,7 @@ def extractIso(isofile, extractfolder, workfolder="", fixfilename=False):
     common.logMessage("Done!")
 
 
+@profile.stage("psp.repackIso", "repack")
 def repackIso(isofile, isopatch, workfolder, patchfile="", fixfilename=False, udf=False, ignorefiles=[]):
     try:
         import pycdlib
@@ -86,11 +88,12 @@ class UMDFile():
         self.filelba = 0
 
 
+@profile.stage("psp.repackUMD", "repack")
 def repackUMD(umdfile, umdpatch, workfolder, patchfile="", sectorpadding=1):
     common.logMessage("Repacking ISO/UMD", umdpatch, "...")
     allfiles = common.getFiles(workfolder)
     isofiles = []
-    with common.Stream(umdfile, "rb") as fin:
+    with common.Stream(umdfile, "mmap") as fin:
         rootlba = fin.readUIntAt(0x809e)
         rootlength = fin.readUIntAt(0x80a6)
         common.logDebug("rootlba", common.toHex(rootlba), "rootlength", common.toHex(rootlength))
@@ -112,13 +115,12 @@ def repackUMD(umdfile, umdpatch, workfolder, patchfile="", sectorpadding=1):
             isofiles.append(isofile)
         # Sort files by file lba
         isofiles.sort(key=lambda x: x.filelba)
-        with common.Stream(umdpatch, "wb") as f:
+        with common.Stream(umdpatch, "wb", buffered=True) as f:
             # Copy everything up to the first file LBA
-            fin.seek(0)
-            f.write(fin.read(isofiles[0].filelba * 0x800))
+            f.write(fin.readViewAt(0, isofiles[0].filelba * 0x800))
             # Write all the files
             for isofile in common.showProgress(isofiles):
-                common.logDebug(common.varsHex(isofile))
+                common.logDebug(common.Lazy(common.varsHex, isofile))
                 # Try to keep the lba the same as before if we can
                 if f.tell() // 0x800 < isofile.filelba:
                     f.seek(isofile.filelba * 0x800)
@@ -208,6 +210,7 @@ class ELFSection():
         self.entsize = 0
 
 
+@profile.stage("psp.readELF", "parse")
 def readELF(infile):
     elf = ELF()
     with common.Stream(infile, "rb") as f:
@@ -244,22 +247,19 @@ def readELF(infile):
 
 
 def extractBinaryStrings(elf, foundstrings, infile, func, encoding="shift_jis", elfsections=[".rodata"]):
-    with common.Stream(infile, "rb") as f:
+    seen = set(foundstrings)
+    with common.Stream(infile, "mmap") as f:
         for sectionname in elfsections:
             rodata = elf.sectionsdict[sectionname]
-            f.seek(rodata.offset)
-            while f.tell() < rodata.offset + rodata.size:
-                pos = f.tell()
-                check = func(f, encoding)
-                if check != "":
-                    if check not in foundstrings:
-                        common.logDebug("Found string at", common.toHex(pos), check)
-                        foundstrings.append(check)
-                    pos = f.tell() - 1
-                f.seek(pos + 1)
+            for pos, check in common.scanBinaryStrings(f, rodata.offset, rodata.offset + rodata.size, func, encoding):
+                if check not in seen:
+                    common.logDebug("Found string at", common.Lazy(common.toHex, pos), check)
+                    seen.add(check)
+                    foundstrings.append(check)
     return foundstrings
 
 
+@profile.stage("psp.repackBinaryStrings", "encode")
 def repackBinaryStrings(elf, section, infile, outfile, readfunc, writefunc, encoding="shift_jis", elfsections=[".rodata"]):
     with common.Stream(infile, "rb") as fi:
         with common.Stream(outfile, "r+b") as fo:
@@ -271,7 +271,7 @@ def repackBinaryStrings(elf, section, infile, outfile, readfunc, writefunc, enco
                     check = readfunc(fi, encoding)
                     if check != "":
                         if check in section and section[check][0] != "":
-                            common.logDebug("Replacing string", check, "at", common.toHex(pos), "with", section[check][0])
+                            common.logDebug("Replacing string", check, "at", common.Lazy(common.toHex, pos), "with", section[check][0])
                             fo.seek(pos)
                             endpos = fi.tell() - 1
                             newlen = writefunc(fo, section[check][0], endpos - pos + 1)
@@ -396,6 +396,7 @@ def readGMOChunk(f, gmo, maxsize, nesting=""):
         f.seek(offset + blocklen)
 
 
+@profile.stage("psp.readGIM", "parse")
 def readGIM(file, start=0):
     gim = GIM()
     with common.Stream(file, "rb") as f:
@@ -480,16 +481,15 @@ def readGIMBlock(f, gim, image):
             common.logError("Unsupported image format:", image.format)
             return image.imgoff + nextblock, image
         f.seek(image.imgoff + 32 + image.imgframeoff)
-        for i in range(image.blockedheight if image.tiled == 0x01 else image.height):
-            for j in range(image.blockedwidth if image.tiled == 0x01 else image.width):
-                index = 0
-                if image.format == 0x04:
-                    index = f.readHalf()
-                elif image.format == 0x05:
-                    index = f.readByte()
-                else:
-                    index = readColor(f, image.format)
-                image.colors.append(index)
+        pixelnum = (image.blockedheight if image.tiled == 0x01 else image.height) * (image.blockedwidth if image.tiled == 0x01 else image.width)
+        if image.format == 0x04 or image.format == 0x05:
+            data = f.readHalves(pixelnum) if image.format == 0x04 else f.read(pixelnum)
+            image.colors.extend(data)
+            if len(data) < pixelnum:
+                common.logWarning("Malformed GIM image data at", common.toHex(image.imgoff))
+        else:
+            for i in range(pixelnum):
+                image.colors.append(readColor(f, image.format))
         common.logDebug("imgoff", image.imgoff, "imgsize", image.imgsize, "imgframeoff", image.imgframeoff, "format", image.format, "bpp", image.bpp)
         common.logDebug("tiled", image.tiled, "width", image.width, "height", image.height)
         common.logDebug("blockedwidth", image.blockedwidth, "blockedheight", image.blockedheight, "tilewidth", image.tilewidth, "tileheight", image.tileheight)
@@ -516,6 +516,7 @@ def readGIMBlock(f, gim, image):
         return offset + f.readUInt(), image
 
 
+@profile.stage("psp.writeGIM", "encode")
 def writeGIM(file, gim, infile, backwardspal=False):
     try:
         from PIL import Image
@@ -530,10 +531,11 @@ def writeGIM(file, gim, infile, backwardspal=False):
         if isinstance(gim, GIM):
             for image in gim.images:
                 f.seek(image.imgoff + 32 + image.imgframeoff)
+                indexes = []
                 if image.tiled == 0x00:
                     for i in range(image.height):
                         for j in range(image.width):
-                            writeGIMPixel(f, image, pixels[j, currheight + i], backwardspal)
+                            writeGIMPixel(f, image, pixels[j, currheight + i], backwardspal, indexes)
                 else:
                     for blocky in range(image.blockedheight // image.tileheight):
                         for blockx in range(image.blockedwidth // image.tilewidth):
@@ -542,9 +544,13 @@ def writeGIM(file, gim, infile, backwardspal=False):
                                     pixelx = blockx * image.tilewidth + x
                                     pixely = currheight + blocky * image.tileheight + y
                                     if pixelx >= image.width or pixely >= currheight + image.height:
-                                        writeGIMPixel(f, image, None, backwardspal)
+                                        writeGIMPixel(f, image, None, backwardspal, indexes)
                                     else:
-                                        writeGIMPixel(f, image, pixels[pixelx, pixely], backwardspal)
+                                        writeGIMPixel(f, image, pixels[pixelx, pixely], backwardspal, indexes)
+                if image.format == 0x04:
+                    f.writeHalves(indexes)
+                elif image.format == 0x05:
+                    f.write(bytes(indexes))
                 if len(image.palette) > 0:
                     palsize = 5 * (len(image.palette) // 8)
                     currheight += max(image.height, palsize)
@@ -557,10 +563,13 @@ def writeGIM(file, gim, infile, backwardspal=False):
                    writeColor(f, 0x03, pixels[j, gim.height - 1 - i])
 
 
-def writeGIMPixel(f, image, color, backwards=False):
+def writeGIMPixel(f, image, color, backwards=False, indexes=None):
     if image.format == 0x04 or image.format == 0x05:
         index = common.getPaletteIndex(image.palette, color, False, 0, -1, True, False, backwards) if color is not None else 0
-        if image.format == 0x04:
+        # Collect the indexes so they can be written in one go
+        if indexes is not None:
+            indexes.append(index)
+        elif image.format == 0x04:
             f.writeHalf(index)
         elif image.format == 0x05:
             f.writeByte(index)
@@ -613,6 +622,7 @@ def writeColor(f, format, color):
         f.writeUInt(enc)
 
 
+@profile.stage("psp.drawGIM", "render")
 def drawGIM(outfile, gim):
     try:
         from PIL import Image
@@ -786,6 +796,7 @@ def setBPETable(f, num, bpe, table):
 
 
 # https://github.com/tpunix/pgftool/blob/master/libpgf.c
+@profile.stage("psp.readPGFData", "parse")
 def readPGFData(file):
     pgf = PGF()
     with common.Stream(file, "rb") as f:
@@ -1023,6 +1034,7 @@ def repackPGFBitmap(glyph, infile):
     return rlev, 0x02, img.width, img.height
 
 
+@profile.stage("psp.extractPGFData", "extract")
 def extractPGFData(file, outfile, bitmapout="", justadvance=False):
     pgf = readPGFData(file)
     with common.Stream(file, "rb") as fin:
@@ -1059,6 +1071,7 @@ def checkPGFDataMap(datamap, newvalue):
     return mapid
 
 
+@profile.stage("psp.repackPGFData", "repack")
 def repackPGFData(fontin, fontout, configfile, bitmapin=""):
     pgf = readPGFData(fontin)
     section = {}
@@ -1,10 +1,11 @@
 import codecs
 import struct
 import os
-from hacktools import common
+from hacktools import common, profile
 
 
 # Image functions
+@profile.stage("psx.extractBIN", "extract")
 def extractBIN(infolder, outfolder, cuefile):
     try:
         import pymkpsxiso
@@ -23,6 +24,7 @@ def extractBIN(infolder, outfolder, cuefile):
     common.logMessage("Done!")
 
 
+@profile.stage("psx.repackBIN", "repack")
 def repackBIN(infolder, binin, binout, cuefile, patchfile=""):
     try:
         import pymkpsxiso
@@ -38,33 +40,37 @@ def repackBIN(infolder, binin, binout, cuefile, patchfile=""):
 
 
 # Binary-related functions
-def extractEXE(binrange, readfunc=common.detectEncodedString, encoding="shift_jis", exein="", exefile="data/exe_output.txt", writepos=False):
+@profile.stage("psx.extractEXE", "extract")
+def extractEXE(binrange, readfunc=common.detectEncodedString, encoding="shift_jis", exein="", exefile="data/exe_output.txt", writepos=False, workers=1):
     common.logMessage("Extracting EXE to", exefile, "...")
     if type(binrange) == tuple:
         binrange = [binrange]
-    strings, positions = common.extractBinaryStrings(exein, binrange, readfunc, encoding)
+    found = common.findBinaryStrings(exein, binrange, readfunc, encoding, workers)
     with codecs.open(exefile, "w", "utf-8") as out:
-        for i in range(len(strings)):
+        for string, positions in found.items():
             if writepos:
-                out.write(common.toHex(positions[i][0]) + "!")
-            out.write(strings[i] + "=\n")
-    common.logMessage("Done! Extracted", len(strings), "lines")
+                out.write(common.toHex(positions[0]) + "!")
+            out.write(string + "=\n")
+    common.logMessage("Done! Extracted", len(found), "lines")
 
 
-def repackEXE(binrange, freeranges=None, manualptrs=None, readfunc=common.detectEncodedString, writefunc=common.writeEncodedString, encoding="shift_jis", comments="#", exein="", exeout="", ptrfile="data/manualptrs.asm", exefile="data/exe_input.txt"):
+@profile.stage("psx.repackEXE", "repack")
+def repackEXE(binrange, freeranges=None, manualptrs=None, readfunc=common.detectEncodedString, writefunc=common.writeEncodedString, encoding="shift_jis", comments="#", exein="", exeout="", ptrfile="data/manualptrs.asm", exefile="data/exe_input.txt", tailmerge=False, incremental=False, reportpointers=False):
     if not os.path.isfile(exefile):
         common.logError("Input file", exefile, "not found")
         return False
 
-    common.copyFile(exein, exeout)
+    # The previous output is updated in place if it has a valid manifest
+    if not incremental or common.readRepackManifest(exeout + ".manifest", exeout) is None:
+        common.copyFile(exein, exeout)
     common.logMessage("Repacking EXE from", exefile, "...")
-    section = {}
-    with codecs.open(exefile, "r", "utf-8") as bin:
-        section = common.getSection(bin, "", comments)
-        chartot, transtot = common.getSectionPercentage(section)
+    section = common.getCachedSection(exefile, "", comments)
+    chartot, transtot = common.getSectionPercentage(section)
     if type(binrange) == tuple:
         binrange = [binrange]
-    notfound = common.repackBinaryStrings(section, exein, exeout, binrange, freeranges, readfunc, writefunc, encoding, 0x8000f800)
+    if reportpointers:
+        common.reportBinaryPointers(exein, binrange, readfunc, encoding, 0x8000f800)
+    notfound = common.repackBinaryStrings(section, exein, exeout, binrange, freeranges, readfunc, writefunc, encoding, 0x8000f800, tailmerge=tailmerge, manifest=exeout + ".manifest" if incremental else "")
     # Handle not found pointers by manually replacing the opcodes
     if len(notfound) > 0 and manualptrs is not None:
         with open(ptrfile, "w") as f:
@@ -85,6 +91,7 @@ def repackEXE(binrange, freeranges=None, manualptrs=None, readfunc=common.detect
 
 
 # Images
+@profile.stage("psx.extractTIM", "extract")
 def extractTIM(infolder, outfolder, extensions=".tim", readfunc=None):
     common.makeFolder(outfolder)
     common.logMessage("Extracting TIM to", outfolder, "...")
@@ -127,6 +134,7 @@ class TIM:
         self.data = []
 
 
+@profile.stage("psx.readTIM", "parse")
 def readTIM(f, forcesize=0):
     tim = TIM()
     # Read header
@@ -176,21 +184,19 @@ def readTIM(f, forcesize=0):
 
 
 def readCLUTData(f, clutwidth):
-    clut = []
-    for j in range(clutwidth):
-        color = common.readRGB5A1(f.readUShort())
-        clut.append(color)
-    return clut
+    return [common.readRGB5A1(x) for x in f.readUShortArray(clutwidth)]
 
 
 def readTIMData(f, tim, pixelnum):
+    if tim.bpp == 4 or tim.bpp == 8:
+        data = f.readHalves(pixelnum) if tim.bpp == 4 else f.read(pixelnum)
+        tim.data.extend(data)
+        if len(data) < pixelnum:
+            common.logWarning("Malformed TIM")
+        return
     try:
         for i in range(pixelnum):
-            if tim.bpp == 4:
-                tim.data.append(f.readHalf())
-            elif tim.bpp == 8:
-                tim.data.append(f.readByte())
-            elif tim.bpp == 16:
+            if tim.bpp == 16:
                 color = common.readRGB5A1(f.readUShort())
                 tim.data.append(color)
             elif tim.bpp == 24:
@@ -215,6 +221,7 @@ def getUniqueCLUT(tim, transp=False):
     return clut
 
 
+@profile.stage("psx.drawTIM", "render")
 def drawTIM(outfile, tim, transp=False, forcepal=-1, allpalettes=False, nopal=False):
     if tim.width == 0 or tim.height == 0:
         return
@@ -262,6 +269,7 @@ def drawTIM(outfile, tim, transp=False, forcepal=-1, allpalettes=False, nopal=Fa
     img.save(outfile, "PNG")
 
 
+@profile.stage("psx.writeTIM", "encode")
 def writeTIM(f, tim, infile, transp=False, forcepal=-1, palsize=0):
     if tim.bpp > 8:
         common.logError("writeTIM bpp", tim.bpp, "not supported")
@@ -283,13 +291,15 @@ def writeTIM(f, tim, infile, transp=False, forcepal=-1, palsize=0):
     else:
         pixels = infile
     f.seek(tim.dataoff)
+    indexes = []
     for i in range(tim.height):
         for j in range(tim.width):
             if j >= maxwidth or i >= maxheight:
                 index = 0
             else:
                 index = common.getPaletteIndex(tim.cluts[clut], pixels[j, i], checkalpha=transp, zerotransp=False)
-            if tim.bpp == 4:
-                f.writeHalf(index)
-            else:
-                f.writeByte(index)
+            indexes.append(index)
+    if tim.bpp == 4:
+        f.writeHalves(indexes)
+    else:
+        f.write(bytes(indexes))
@@ -1,7 +1,7 @@
 import codecs
 import math
 import os
-from hacktools import common
+from hacktools import common, profile
 
 
 # Generic extract/repack functions
@@ -15,6 +15,7 @@ def extractARC(infolder, outfolder):
     common.logMessage("Done! Extracted", len(files), "files")
 
 
+@profile.stage("wii.extractTPL", "extract")
 def extractTPL(infolder, outfolder, splitName=True):
     common.makeFolder(outfolder)
     common.logMessage("Extracting TPL to", outfolder, "...")
@@ -66,6 +67,7 @@ def repackBRFNT(outfile, workfile):
     os.remove(outfile.replace(".brfnt", ".vbfta"))
 
 
+@profile.stage("wii.extractIso", "extract")
 def extractIso(isofile, extractfolder, workfolder=""):
     common.logMessage("Extracting ISO", isofile, "...")
     common.makeFolder(extractfolder)
@@ -75,6 +77,7 @@ def extractIso(isofile, extractfolder, workfolder=""):
     common.logMessage("Done!")
 
 
+@profile.stage("wii.repackIso", "repack")
 def repackIso(isofile, isopatch, workfolder, patchfile=""):
     common.logMessage("Repacking ISO", isopatch, "...")
     if os.path.isfile(isopatch):
@@ -109,6 +112,7 @@ class TPLImage:
         self.blockheight = 0
 
 
+@profile.stage("wii.readTPL", "parse")
 def readTPL(file):
     tpl = TPL()
     with common.Stream(file, "rb", False) as f:
@@ -132,8 +136,7 @@ def readTPL(file):
                     common.logError("Unimplemented palette format:", image.palformat)
                     continue
                 f.seek(image.paldataoff)
-                for j in range(palcount):
-                    image.palette.append(common.readRGB5A3(f.readShort()))
+                image.palette = [common.readRGB5A3(x) for x in f.readShortArray(palcount)]
             f.seek(image.imgoff)
             image.height = f.readUShort()
             image.width = f.readUShort()
@@ -149,6 +152,7 @@ def readTPL(file):
     return tpl
 
 
+@profile.stage("wii.writeTPL", "encode")
 def writeTPL(file, tpl, infile):
     try:
         from PIL import Image
@@ -173,6 +177,7 @@ def writeTPL(file, tpl, infile):
                 f.writeUShort(image.width)
             pixels = img.load()
             f.seek(image.dataoff)
+            indexes = []
             for y in range(0, image.blockheight, image.tileheight):
                 for x in range(0, image.blockwidth, image.tilewidth):
                     for y2 in range(image.tileheight):
@@ -184,10 +189,11 @@ def writeTPL(file, tpl, infile):
                                     index = ((color[3] // 0x11) << 4) | (color[0] // 0x11)
                                 else:
                                     index = common.getPaletteIndex(image.palette, color, False, 0, -1, True, False)
-                            if image.format == 0x08:
-                                f.writeHalf(index, False)
-                            else:
-                                f.writeByte(index)
+                            indexes.append(index)
+            if image.format == 0x08:
+                f.writeHalves(indexes, False)
+            else:
+                f.write(bytes(indexes))
 
 
 # Font files
@@ -222,7 +228,7 @@ def getFontGlyphs(file, encoding="shift_jis"):
             sectiontype = f.readUShort()
             f.seek(2, 1)
             nextoffset = f.readUInt()
-            common.logDebug("firstchar:", common.toHex(firstchar), "lastchar:", common.toHex(lastchar), "sectiontype:", sectiontype, "nextoffset:", nextoffset)
+            common.logDebug("firstchar:", common.Lazy(common.toHex, firstchar), "lastchar:", common.Lazy(common.toHex, lastchar), "sectiontype:", sectiontype, "nextoffset:", nextoffset)
             if sectiontype == 0:
                 firstcode = f.readUShort()
                 for i in range(lastchar - firstchar + 1):
@@ -0,0 +1,695 @@
+import argparse
+import codecs
+import json
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hacktools import common, compression, cmp_cri, cmp_lzss, cmp_racjin, cpk, nitro, psp, psx, wii, __version__
+
+try:
+    from PIL import Image
+    hasPIL = True
+except ImportError:
+    hasPIL = False
+
+# Multiplier applied to the number of tiles, files, glyphs and bytes of each fixture
+scales = {"small": 1, "medium": 4, "large": 16}
+
+
+# Synthetic fixtures, all the data is generated from a fixed seed
+def getData(size, seed=0):
+    rng = random.Random(seed)
+    words = [bytes(rng.randrange(0x61, 0x7b) for _ in range(rng.randrange(2, 9))) for _ in range(64)]
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(words) + b" "
+    return bytes(data[:size])
+
+
+def getRandomData(size, seed=0):
+    rng = random.Random(seed)
+    return bytes(rng.randrange(0x100) for _ in range(size))
+
+
+def getColor(i):
+    # Distinct BGR555 colors for the first 256 indexes
+    return (i * 0x7f) & 0x7fff
+
+
+def writeNitroHeader(f, magic, section, size):
+    f.write(magic)
+    f.writeUShort(0xfeff)
+    f.writeUShort(0x0100)
+    f.writeUInt(0x10 + size)
+    f.writeUShort(0x10)
+    f.writeUShort(1)
+    f.write(section)
+    f.writeUInt(size)
+
+
+def writeNCLR(file, palnum):
+    pallen = palnum * 16 * 2
+    with common.Stream(file, "wb") as f:
+        writeNitroHeader(f, b"RLCN", b"TTLP", 0x18 + pallen)
+        f.writeUShort(0x03)
+        f.writeZero(6)
+        f.writeUInt(pallen)
+        f.writeUInt(0x10)
+        for i in range(palnum * 16):
+            f.writeUShort(getColor(i))
+
+
+def writeNCGR(file, width, height):
+    tilelen = width * height * 32
+    with common.Stream(file, "wb") as f:
+        writeNitroHeader(f, b"RGCN", b"RAHC", 0x20 + tilelen)
+        f.writeUShort(height)
+        f.writeUShort(width)
+        f.writeUInt(0x03)
+        f.writeUInt(0)
+        f.writeUInt(0)
+        f.writeUInt(tilelen)
+        f.writeUInt(0x18)
+        f.write(getRandomData(tilelen))
+
+
+def writeNSCR(file, width, height, tilenum):
+    maplen = (width // 8) * (height // 8) * 2
+    with common.Stream(file, "wb") as f:
+        writeNitroHeader(f, b"RCSN", b"NRCS", 0x14 + maplen)
+        f.writeUShort(width)
+        f.writeUShort(height)
+        f.writeUInt(0)
+        f.writeUInt(maplen)
+        for i in range(maplen // 2):
+            f.writeUShort(((i % 16) << 12) | (i % tilenum))
+
+
+def writeNCER(file, banknum, tilenum):
+    cellnum = 4
+    with common.Stream(file, "wb") as f:
+        writeNitroHeader(f, b"RECN", b"KBEC", 0x20 + banknum * (8 + cellnum * 6))
+        f.writeUShort(banknum)
+        f.writeUShort(0)
+        f.writeUInt(0x18)
+        f.writeUInt(0)
+        f.writeUInt(0)
+        f.writeZero(8)
+        for i in range(banknum):
+            f.writeUShort(cellnum)
+            f.writeUShort(0)
+            f.writeUInt(i * cellnum * 6)
+        for i in range(banknum):
+            for j in range(cellnum):
+                # 16x16 cells in a 2x2 grid
+                f.writeUShort((j // 2) * 16)
+                f.writeUShort((1 << 14) | ((j % 2) * 16))
+                f.writeUShort(((i * cellnum + j) * 4) % (tilenum - 4))
+
+
+def writeNARC(file, filenum):
+    files = [getRandomData(0x200 + (i % 8) * 0x80, i) for i in range(filenum)]
+    names = [("file" + str(i).zfill(4) + ".bin").encode("ascii") for i in range(filenum)]
+    btnflen = 16 + sum(len(x) + 1 for x in names) + 1
+    btnflen += (4 - btnflen % 4) % 4
+    with common.Stream(file, "wb") as f:
+        f.write(b"NARC")
+        f.writeUShort(0xfffe)
+        f.writeUShort(0x0100)
+        f.writeUInt(0)
+        f.writeUShort(0x10)
+        f.writeUShort(3)
+        f.write(b"BTAF")
+        f.writeUInt(12 + filenum * 8)
+        f.writeUInt(filenum)
+        pos = 0
+        for data in files:
+            f.writeUInt(pos)
+            f.writeUInt(pos + len(data))
+            pos += len(data) + (4 - len(data) % 4) % 4
+        btnf = f.tell()
+        f.write(b"BTNF")
+        f.writeUInt(btnflen)
+        f.writeUInt(8)
+        f.writeUShort(0)
+        f.writeUShort(1)
+        for name in names:
+            f.writeByte(len(name))
+            f.write(name)
+        f.writeZero(btnf + btnflen - f.tell())
+        f.write(b"GMIF")
+        f.writeUInt(8 + pos)
+        for data in files:
+            f.write(data)
+            f.writeZero((4 - len(data) % 4) % 4)
+        f.writeUIntAt(8, f.tell())
+
+
+def writeNSBMD(file, texnum):
+    # Textures alternate between 16 and 256 colors, each one with its own palette
+    formats = [3 if i % 2 == 0 else 4 for i in range(texnum)]
+    texsizes = [64 * 64 // (2 if x == 3 else 1) for x in formats]
+    palsizes = [16 * 2 if x == 3 else 256 * 2 for x in formats]
+    paldef = 76 + texnum * 28
+    texdata = paldef + 16 + texnum * 24
+    texdata += (8 - texdata % 8) % 8
+    paldata = texdata + sum(texsizes)
+    with common.Stream(file, "wb") as f:
+        f.write(b"BMD0")
+        f.writeUShort(0xfeff)
+        f.writeUShort(0x0002)
+        f.writeUInt(32 + paldata + sum(palsizes))
+        f.writeUShort(0x10)
+        f.writeUShort(2)
+        f.writeUInt(24)
+        f.writeUInt(32)
+        f.write(b"MDL0")
+        f.writeUInt(8)
+        # TEX0 header
+        f.write(b"TEX0")
+        f.writeUInt(paldata + sum(palsizes))
+        f.writeZero(4)
+        f.writeUShort(sum(texsizes) // 8)
+        f.writeZero(6)
+        f.writeUInt(texdata)
+        f.writeZero(4)
+        f.writeUShort(0)
+        f.writeZero(6)
+        f.writeUInt(0)
+        f.writeUInt(0)
+        f.writeZero(4)
+        f.writeUShort(sum(palsizes) // 8)
+        f.writeZero(2)
+        f.writeUInt(paldef)
+        f.writeUInt(paldata)
+        # Texture definitions
+        f.writeByte(0)
+        f.writeByte(texnum)
+        f.writeZero(14 + texnum * 4)
+        offset = 0
+        for i in range(texnum):
+            f.writeUShort(offset // 8)
+            f.writeUShort((formats[i] << 10) | (3 << 7) | (3 << 4))
+            f.writeZero(4)
+            offset += texsizes[i]
+        for i in range(texnum):
+            f.write(("tex" + str(i)).encode("ascii").ljust(16, b"\x00"))
+        # Palette definitions
+        f.writeByte(0)
+        f.writeByte(texnum)
+        f.writeZero(14 + texnum * 4)
+        offset = 0
+        for i in range(texnum):
+            f.writeUShort(offset // 8)
+            f.writeZero(2)
+            offset += palsizes[i]
+        for i in range(texnum):
+            f.write(("pal" + str(i)).encode("ascii").ljust(16, b"\x00"))
+        f.writeZero(32 + texdata - f.tell())
+        for i in range(texnum):
+            data = bytearray(getRandomData(texsizes[i], i))
+            if formats[i] == 3:
+                # Avoid the transparent index so the colors survive a draw/write round trip
+                data = bytes(x | 0x11 for x in data)
+            f.write(data)
+        for i in range(texnum):
+            for j in range(palsizes[i] // 2):
+                f.writeUShort(getColor(j))
+
+
+def getUTF(columns, rows, name="TABLE"):
+    # columns is a list of (name, type), rows a list of lists of values, strings and bytes are stored in their tables
+    strings = bytearray(b"<NULL>\x00")
+    stringoffsets = {}
+
+    def addString(s):
+        if s not in stringoffsets:
+            stringoffsets[s] = len(strings)
+            strings.extend(s.encode("ascii") + b"\x00")
+        return stringoffsets[s]
+    data = bytearray()
+    sizes = {0: 1, 2: 2, 4: 4, 6: 8, 0xa: 4, 0xb: 8}
+    formats = {0: "B", 2: "H", 4: "I", 6: "Q"}
+    rowlength = sum(sizes[x[1]] for x in columns)
+    tablename = addString(name)
+    with common.Stream(little=False) as f:
+        f.write(b"@UTF")
+        f.writeUInt(0)
+        f.writeUInt(0x18 + len(columns) * 5)
+        f.writeUInt(0)
+        f.writeUInt(0)
+        f.writeUInt(tablename)
+        f.writeUShort(len(columns))
+        f.writeUShort(rowlength)
+        f.writeUInt(len(rows))
+        for column in columns:
+            f.writeByte(cpk.UTFColumnFlags.STORAGE_PERROW | column[1])
+            f.writeUInt(addString(column[0]))
+        for row in rows:
+            for i in range(len(columns)):
+                type = columns[i][1]
+                if type == 0xa:
+                    f.writeUInt(addString(row[i]))
+                elif type == 0xb:
+                    f.writeUInt(len(data))
+                    f.writeUInt(len(row[i]))
+                    data.extend(row[i])
+                else:
+                    f.write(struct.pack(">" + formats[type], row[i]))
+        f.writeUIntAt(12, f.tell() - 8)
+        f.write(strings)
+        f.writeUIntAt(16, f.tell() - 8)
+        f.write(data)
+        f.writeZero((8 - f.tell() % 8) % 8)
+        f.writeUIntAt(4, f.tell() - 8)
+        f.seek(0)
+        return f.read()
+
+
+def writeCPKPacket(f, magic, packet):
+    f.write(magic)
+    f.writeUInt(0xff)
+    f.writeULong(len(packet))
+    f.write(packet)
+
+
+def writeCPK(file, filenum):
+    files = []
+    for i in range(filenum):
+        data = getData(0x800 + (i % 4) * 0x200, i)
+        # Compress half of the files so both extraction paths are measured
+        files.append((data, cmp_cri.compressCRILAYLA(data) if i % 2 == 0 else data))
+    tocalign = 0x800
+    columns = [("DirName", 0xa), ("FileName", 0xa), ("FileSize", 4), ("ExtractSize", 4), ("FileOffset", 6), ("ID", 4), ("UserString", 0xa)]
+    # The TOC size doesn't depend on the offsets, build it once to know where the content starts
+    rows = [["dir" + str(i % 4), "file" + str(i).zfill(4) + ".bin", 0, 0, 0, i, "<NULL>"] for i in range(filenum)]
+    toclen = 0x10 + len(getUTF(columns, rows, "CpkTocInfo"))
+    contentoffset = tocalign + toclen + (tocalign - toclen % tocalign) % tocalign
+    offset = contentoffset - tocalign
+    for i in range(filenum):
+        rows[i][2] = len(files[i][1])
+        rows[i][3] = len(files[i][0])
+        rows[i][4] = offset
+        offset += len(files[i][1]) + (tocalign - len(files[i][1]) % tocalign) % tocalign
+    header = getUTF([("TocOffset", 6), ("ContentOffset", 6), ("Files", 4), ("Align", 2)], [[tocalign, contentoffset, filenum, tocalign]], "CpkHeader")
+    with common.Stream(file, "wb") as f:
+        writeCPKPacket(f, b"CPK ", header)
+        f.writeZero(tocalign - f.tell())
+        writeCPKPacket(f, b"TOC ", getUTF(columns, rows, "CpkTocInfo"))
+        f.writeZero(contentoffset - f.tell())
+        for i in range(filenum):
+            f.write(files[i][1])
+            if i + 1 < filenum:
+                f.writeZero((tocalign - len(files[i][1]) % tocalign) % tocalign)
+
+
+def writeGIM(file, width, height):
+    # 4bpp tiled image with a 16 colors RGBA8888 palette
+    datalen = width * height // 2
+    with common.Stream(file, "wb") as f:
+        f.write(b"MIG.00.1PSP\x00")
+        f.writeZero(4)
+        for id in [0x02, 0x03]:
+            f.writeUShort(id)
+            f.writeUShort(0)
+            f.writeUInt(0)
+            f.writeUInt(0x10)
+            f.writeUInt(0x10)
+        f.writeUShort(0x04)
+        f.writeUShort(0)
+        f.writeUInt(0x20 + datalen)
+        f.writeUInt(0x20 + datalen)
+        f.writeUInt(0x10)
+        f.writeUShort(0)
+        f.writeUShort(0)
+        f.writeUShort(0x04)
+        f.writeUShort(0x01)
+        f.writeUShort(width)
+        f.writeUShort(height)
+        f.writeZero(4)
+        f.write(getRandomData(datalen))
+        f.writeUShort(0x05)
+        f.writeUShort(0)
+        f.writeUInt(0x20 + 0x40)
+        f.writeUInt(0x20 + 0x40)
+        f.writeUInt(0x10)
+        f.writeUShort(0)
+        f.writeUShort(0)
+        f.writeUShort(0x03)
+        f.writeZero(10)
+        for i in range(16):
+            f.writeUInt(0xff000000 | (i * 0x0f0d0b))
+        f.writeUIntAt(20, f.tell() - 16)
+
+
+def writePGF(file, glyphnum):
+    glyphs = []
+    for i in range(glyphnum):
+        bitmap = psp.bitmapRLE([(x * 3 + i) % 16 if x % 5 else 0 for x in range(16 * 16)])
+        data = bytearray(40)
+        # Size, width, height, left, top, flag (horizontal RLE), shadow flag and id, followed by the explicit metrics
+        pos = psp.setBPEValue(14, data, 0, 40 + len(bitmap))
+        for bpe, value in [(7, 16), (7, 16), (7, 0), (7, 14), (6, 0x01), (7, 21), (9, 0)]:
+            pos = psp.setBPEValue(bpe, data, pos, value)
+        for value in [16, 16, 0, 14, 0, 14, 17, 0]:
+            pos = psp.setBPEValue(32, data, pos, value * 64)
+        data += bitmap
+        data += bytes((4 - len(data) % 4) % 4)
+        glyphs.append(data)
+    with common.Stream(file, "wb") as f:
+        f.write(b"\x00\x00")
+        f.writeUShort(0x188)
+        f.write(b"PGF0")
+        f.writeZero(0x10 - f.tell())
+        f.writeUInt(glyphnum)
+        f.writeUInt(glyphnum)
+        f.writeUInt(16)
+        f.writeUInt(16)
+        f.writeZero(0xb6 - f.tell())
+        f.writeUShort(0x4e00)
+        f.writeUShort(0x4e00 + glyphnum - 1)
+        f.writeZero(0x100 - f.tell())
+        f.writeUShort(4)
+        f.writeZero(0x188 - f.tell())
+        psp.setBPETable(f, glyphnum, 16, list(range(glyphnum)))
+        ptrs = []
+        pos = 0
+        for glyph in glyphs:
+            ptrs.append(pos // 4)
+            pos += len(glyph)
+        psp.setBPETable(f, glyphnum, 16, ptrs)
+        for glyph in glyphs:
+            f.write(glyph)
+
+
+def writeTIM(file, width, height):
+    with common.Stream(file, "wb") as f:
+        f.writeUInt(0x10)
+        f.writeUInt(0x08)
+        f.writeUInt(12 + 16 * 2)
+        f.writeUShort(0)
+        f.writeUShort(0)
+        f.writeUShort(16)
+        f.writeUShort(1)
+        for i in range(16):
+            f.writeUShort(0x8000 | getColor(i + 1))
+        f.writeUInt(12 + width * height // 2)
+        f.writeUShort(0)
+        f.writeUShort(0)
+        f.writeUShort(width // 4)
+        f.writeUShort(height)
+        f.write(getRandomData(width * height // 2))
+
+
+def writeTPL(file, width, height):
+    # C8 image with a 256 colors RGB5A3 palette
+    with common.Stream(file, "wb", False) as f:
+        f.writeUInt(0x0020af30)
+        f.writeUInt(1)
+        f.writeUInt(12)
+        f.writeUInt(20)
+        f.writeUInt(32)
+        f.writeUShort(height)
+        f.writeUShort(width)
+        f.writeUInt(0x09)
+        f.writeUInt(0x40 + 256 * 2)
+        f.writeUShort(256)
+        f.writeByte(0)
+        f.writeByte(0)
+        f.writeUInt(0x02)
+        f.writeUInt(0x40)
+        f.writeZero(0x40 - f.tell())
+        for i in range(256):
+            f.writeUShort(0x8000 | getColor(i))
+        f.write(getRandomData(width * height))
+
+
+def writePRS(data):
+    # Simple PRS encoder using literals and short copies, enough to exercise the decoder
+    out = bytearray()
+    state = {"flagpos": -1, "bits": 0}
+
+    def writeBit(bit):
+        if state["bits"] == 0:
+            state["flagpos"] = len(out)
+            out.append(0)
+            state["bits"] = 8
+        state["bits"] -= 1
+        out[state["flagpos"]] |= bit << state["bits"]
+    i = 0
+    while i < len(data):
+        best = 0
+        bestoffset = 0
+        for offset in range(1, min(i, 0x100) + 1):
+            length = 0
+            while length < 5 and i + length < len(data) and data[i + length] == data[i + length - offset]:
+                length += 1
+            if length > best:
+                best = length
+                bestoffset = offset
+                if best == 5:
+                    break
+        if best >= 2:
+            writeBit(0)
+            writeBit(0)
+            writeBit((best - 2) >> 1)
+            writeBit((best - 2) & 1)
+            out.append(0x100 - bestoffset)
+            i += best
+        else:
+            writeBit(1)
+            out.append(data[i])
+            i += 1
+    return bytes(out)
+
+
+# Benchmark cases
+class Case:
+    def __init__(self, name, func, setup=None, needspil=False):
+        self.name = name
+        self.func = func
+        self.setup = setup
+        self.needspil = needspil
+
+
+def getNitroCases(folder, scale):
+    cases = []
+    nclr = folder + "test.NCLR"
+    ncgr = folder + "test.NCGR"
+    nscr = folder + "test.NSCR"
+    ncer = folder + "test.NCER"
+    width = 32
+    height = 8 * scale
+    writeNCLR(nclr, 16)
+    writeNCGR(ncgr, width, height)
+    writeNSCR(nscr, width * 8, height * 8, width * height)
+    writeNCER(ncer, 8 * scale, width * height)
+    cases.append(Case("nitro.NCLR.read", lambda: nitro.readNCLR(nclr)))
+    cases.append(Case("nitro.NCGR.read", lambda: nitro.readNCGR(ncgr)))
+    cases.append(Case("nitro.NSCR.read", lambda: nitro.readNSCR(nscr)))
+    cases.append(Case("nitro.NCER.read", lambda: nitro.readNCER(ncer)))
+    palettes, tiles, maps, cells, _, _ = nitro.readNitroGraphic(nclr, ncgr, nscr, ncer)
+    cases.append(Case("nitro.NCGR.draw", lambda: nitro.drawNCGR(folder + "ncgr.png", None, tiles, palettes, tiles.width, tiles.height), needspil=True))
+    cases.append(Case("nitro.NCGR.write", lambda: nitro.writeNCGR(ncgr, tiles, folder + "ncgr.png", palettes), needspil=True))
+    cases.append(Case("nitro.NSCR.draw", lambda: nitro.drawNCGR(folder + "nscr.png", maps, tiles, palettes, maps.width, maps.height), needspil=True))
+    cases.append(Case("nitro.NSCR.write", lambda: nitro.writeNSCR(ncgr, tiles, maps, folder + "nscr.png", palettes, maps.width, maps.height), needspil=True))
+    cases.append(Case("nitro.NCER.draw", lambda: nitro.drawNCER(folder + "ncer.png", cells, tiles, palettes), needspil=True))
+    cases.append(Case("nitro.NCER.write", lambda: nitro.writeNCER(ncgr, ncer, tiles, cells, folder + "ncer.png", palettes), needspil=True))
+    # NARC
+    narcfile = folder + "test.narc"
+    writeNARC(narcfile, 16 * scale)
+    narc = nitro.readNARC(narcfile)
+    cases.append(Case("nitro.NARC.read", lambda: nitro.readNARC(narcfile)))
+    cases.append(Case("nitro.NARC.extract", lambda: nitro.extractNARC(narcfile, folder + "narc", narc)))
+    cases.append(Case("nitro.NARC.repack", lambda: nitro.repackNARC(narcfile, folder + "out.narc", folder + "narc", narc)))
+    # NSBMD
+    nsbmdfile = folder + "test.nsbmd"
+    writeNSBMD(nsbmdfile, 2 * scale)
+    nsbmd = nitro.readNSBMD(nsbmdfile)
+    cases.append(Case("nitro.NSBMD.read", lambda: nitro.readNSBMD(nsbmdfile)))
+
+    def drawTextures():
+        for i in range(len(nsbmd.textures)):
+            nitro.drawNSBMD(folder + "tex" + str(i) + ".png", nsbmd, i)
+
+    def writeTextures():
+        for i in range(len(nsbmd.textures)):
+            nitro.writeNSBMD(nsbmdfile, nsbmd, i, folder + "tex" + str(i) + ".png")
+    cases.append(Case("nitro.NSBMD.draw", drawTextures, needspil=True))
+    cases.append(Case("nitro.NSBMD.write", writeTextures, needspil=True))
+    return cases
+
+
+def getCPKCases(folder, scale):
+    cpkfile = folder + "test.cpk"
+    writeCPK(cpkfile, 32 * scale)
+    extractfolder = folder + "cpk_extract/"
+    workfolder = folder + "cpk_work/"
+    cpk.extract(cpkfile, extractfolder)
+    # Only some files are changed, so the repack copies the others directly
+    common.makeFolder(workfolder)
+    for i in range(0, 32 * scale, 4):
+        common.makeFolders(workfolder + "dir" + str(i % 4))
+        shutil.copyfile(extractfolder + "dir" + str(i % 4) + "/file" + str(i).zfill(4) + ".bin", workfolder + "dir" + str(i % 4) + "/file" + str(i).zfill(4) + ".bin")
+
+    def clearCache():
+        for file in common.getFiles(workfolder, ".cache"):
+            os.remove(workfolder + file)
+    return [
+        Case("cpk.CPK.read", lambda: cpk.readCPK(cpkfile)),
+        Case("cpk.CPK.extract", lambda: cpk.extract(cpkfile, extractfolder)),
+        Case("cpk.CPK.repack", lambda: cpk.repack(cpkfile, folder + "out.cpk", extractfolder, workfolder), clearCache),
+    ]
+
+
+def getPSPCases(folder, scale):
+    gimfile = folder + "test.gim"
+    writeGIM(gimfile, 128, 64 * scale)
+    gim = psp.readGIM(gimfile)
+    pgffile = folder + "test.pgf"
+    writePGF(pgffile, 64 * scale)
+    psp.extractPGFData(pgffile, folder + "pgf.txt")
+    common.makeFolder(folder + "pgf")
+    return [
+        Case("psp.GIM.read", lambda: psp.readGIM(gimfile)),
+        Case("psp.GIM.draw", lambda: psp.drawGIM(folder + "gim.png", gim), needspil=True),
+        Case("psp.GIM.write", lambda: psp.writeGIM(gimfile, gim, folder + "gim.png"), needspil=True),
+        Case("psp.PGF.read", lambda: psp.readPGFData(pgffile)),
+        Case("psp.PGF.draw", lambda: psp.extractPGFData(pgffile, folder + "pgf.txt", folder + "pgf/"), needspil=True),
+        Case("psp.PGF.write", lambda: psp.repackPGFData(pgffile, folder + "out.pgf", folder + "pgf.txt", folder + "pgf/" if hasPIL else "")),
+    ]
+
+
+def getPSXCases(folder, scale):
+    timfile = folder + "test.tim"
+    writeTIM(timfile, 256, 64 * scale)
+
+    def readFile():
+        with common.Stream(timfile, "rb") as f:
+            return psx.readTIM(f)
+    tim = readFile()
+
+    def writeFile():
+        with common.Stream(timfile, "r+b") as f:
+            psx.writeTIM(f, tim, folder + "tim.png")
+    return [
+        Case("psx.TIM.read", readFile),
+        Case("psx.TIM.draw", lambda: psx.drawTIM(folder + "tim.png", tim), needspil=True),
+        Case("psx.TIM.write", writeFile, needspil=True),
+    ]
+
+
+def getWiiCases(folder, scale):
+    tplfile = folder + "test.tpl"
+    writeTPL(tplfile, 128, 64 * scale)
+    tpl = wii.readTPL(tplfile)
+    if hasPIL:
+        img = Image.new("RGBA", (128, 64 * scale))
+        pixels = img.load()
+        for y in range(img.height):
+            for x in range(img.width):
+                pixels[x, y] = tpl.images[0].palette[(x + y) % 256]
+        img.save(folder + "tpl.png")
+    return [
+        Case("wii.TPL.read", lambda: wii.readTPL(tplfile)),
+        Case("wii.TPL.write", lambda: wii.writeTPL(tplfile, tpl, folder + "tpl.png"), needspil=True),
+    ]
+
+
+def getCodecCases(folder, scale):
+    cases = []
+    data = getData(0x4000 * scale)
+    codecs = [
+        ("LZ10", lambda x: cmp_lzss.compressLZ10(x, 1), lambda x: cmp_lzss.decompressLZ10(x, len(data), 1)),
+        ("LZ11", lambda x: cmp_lzss.compressLZ11(x, 1), lambda x: cmp_lzss.decompressLZ11(x, len(data), 1)),
+        ("CRILAYLA", cmp_cri.compressCRILAYLA, cmp_cri.decompressCRILAYLA),
+        ("RACJIN", cmp_racjin.compressRACJIN, lambda x: cmp_racjin.decompressRACJIN(x, len(data))),
+        ("Huffman", compression.compressHuffman, lambda x: compression.decompressHuffman(x, len(data))),
+    ]
+    for name, compress, decompress in codecs:
+        compressed = compress(data)
+        if decompress(compressed) != data:
+            raise ValueError(name + " round trip failed")
+        cases.append(Case("codec." + name + ".compress", lambda compress=compress: compress(data)))
+        cases.append(Case("codec." + name + ".decompress", lambda decompress=decompress, compressed=compressed: decompress(compressed)))
+    prsdata = writePRS(data)
+
+    def decompressPRS():
+        with common.Stream.fromBuffer(prsdata) as f:
+            return compression.decompressPRS(f, len(prsdata), len(data))
+    if decompressPRS() != data:
+        raise ValueError("PRS round trip failed")
+    cases.append(Case("codec.PRS.decompress", decompressPRS))
+    return cases
+
+
+def runCase(case, repeat):
+    times = []
+    for _ in range(repeat):
+        if case.setup is not None:
+            case.setup()
+        start = time.perf_counter()
+        case.func()
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "mean": sum(times) / len(times), "runs": len(times)}
+
+
+def run(sizes, repeat=3, filter=""):
+    results = {}
+    for size in sizes:
+        folder = tempfile.mkdtemp(prefix="hacktools_bench_") + "/"
+        try:
+            cases = []
+            for getCases in [getNitroCases, getCPKCases, getPSPCases, getPSXCases, getWiiCases, getCodecCases]:
+                cases.extend(getCases(folder, scales[size]))
+            for case in cases:
+                name = case.name + "." + size
+                if filter not in name or (case.needspil and not hasPIL):
+                    continue
+                results[name] = runCase(case, repeat)
+                print(name.ljust(40), "{:.4f}s".format(results[name]["best"]))
+        finally:
+            shutil.rmtree(folder)
+    return {"python": sys.version.split()[0], "hacktools": __version__, "pil": hasPIL, "cases": results}
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        ratio = result["best"] / max(baseline["cases"][name]["best"], 1e-9)
+        if ratio > 1 + threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hacktools format readers, writers and codecs on synthetic data.")
+    parser.add_argument("--sizes", default="small,medium", help="Comma separated list of " + ", ".join(scales.keys()))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--filter", default="", help="Only run cases containing this string")
+    parser.add_argument("--output", default="benchmark.json", help="Results file, can be used as a baseline for later runs")
+    parser.add_argument("--baseline", default="", help="Baseline results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed slowdown before a case is considered a regression")
+    args = parser.parse_args()
+    results = run(args.sizes.split(","), args.repeat, args.filter)
+    with codecs.open(args.output, "w", "utf-8") as f:
+        json.dump(results, f, indent=2)
+    if args.baseline != "":
+        with codecs.open(args.baseline, "r", "utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, ratio in regressions:
+            print(name, "regressed by {:.0f}%".format((ratio - 1) * 100))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+import benchmark
+
+
+def test_benchmark():
+    # Runs every case once on the smallest fixtures, so the generated files stay valid for the readers
+    results = benchmark.run(["small"], 1)
+    assert "cpk.CPK.repack.small" in results["cases"]
+    assert "codec.PRS.decompress.small" in results["cases"]
+    assert benchmark.compare(results, results, 0.0) == []
+    slower = {"cases": {name: {"best": result["best"] / 2} for name, result in results["cases"].items()}}
+    assert len(benchmark.compare(results, slower, 0.5)) > 0
@@ -1,6 +1,6 @@
 import pytest
 import os.path
-from hacktools import cmp_lzss, cmp_cri, cmp_racjin
+from hacktools import arch, compression, cmp_lzss, cmp_cri, cmp_racjin
 
 @pytest.fixture
 def data():
@@ -35,3 +35,15 @@ def test_cmp_racjin(data):
     decmp = cmp_racjin.decompressRACJIN(cmp, len(data))
     assert len(data) == len(decmp)
     assert data == decmp
+
+
+def test_cmp_huffman(data):
+    cmp = compression.compressHuffman(data)
+    decmp = compression.decompressHuffman(cmp, len(data))
+    assert data == decmp
+
+
+def test_cmp_arch(data):
+    cmp = arch.compress(data)
+    decmp = arch.decompress(cmp, len(data))
+    assert data == decmp
@@ -0,0 +1,604 @@
+import array
+import functools
+import json
+import logging
+import random
+import struct
+import xml.etree.ElementTree as ET
+from hacktools import common, profile
+
+
+def test_stream_readarray():
+    values = [0, 1, 0x7fff, 0x8000, 0xffff]
+    for little in [True, False]:
+        with common.Stream(little=little) as f:
+            f.write(struct.pack(f.endian + "5H", *values))
+            f.seek(0)
+            assert list(f.readUShortArray(5)) == values
+            assert f.tell() == 10
+            assert list(f.readArrayAt(6, "h", 2)) == [-0x8000, -1]
+            assert f.tell() == 10
+
+
+def test_stream_mmap(tmp_path):
+    path = str(tmp_path / "test.bin")
+    with common.Stream(path, "wb") as f:
+        f.write(b"TEST")
+        f.writeUInt(0x12345678)
+        f.write(b"abc\x00")
+    with common.Stream(path, "mmap") as f:
+        assert f.read(4) == b"TEST"
+        assert f.readUInt() == 0x12345678
+        assert f.readUIntAt(4) == 0x12345678
+        assert f.readAt(0, 4) == b"TEST"
+        assert f.peek(3) == b"abc"
+        assert bytes(f.readViewAt(8, 3)) == b"abc"
+        assert f.tell() == 8
+        assert f.readNullString() == "abc"
+
+
+def test_stream_strings():
+    with common.Stream() as f:
+        f.write(b"\x00\x00AB\x82C\x86\x00D\x00" + "テスト".encode("utf-8") + b"\x00" + b"x" * 0x300 + b"\x00")
+        f.seek(0)
+        f.readZeros(10)
+        assert f.tell() == 2
+        assert f.readBytes(3, True) == "41 42 82 "
+        f.seek(2)
+        assert f.readString(6) == "AB C "
+        assert f.readNullString() == "D"
+        assert f.readEncodedString() == "テスト"
+        assert f.readNullString() == "x" * 0x300
+        assert f.peek(1) == b""
+
+
+def test_stream_buffered(tmp_path):
+    path = str(tmp_path / "test.bin")
+    with common.Stream(path, "w+b", buffered=True) as f:
+        f.writeZero(8)
+        f.writeUIntAt(4, 0x11111111)
+        f.writeUIntAt(0, 0x22222222)
+        f.writeUIntAt(2, 0x33333333)
+        f.write(b"abcd")
+        assert f.tell() == 12
+        f.writeAt(10, b"XY")
+        f.seek(-2, 1)
+        f.write(b"cd")
+        assert f.readUIntAt(0) == 0x33332222
+    with common.Stream(path, "rb") as f:
+        assert f.read() == bytes.fromhex("22 22 33 33 33 33 11 11") + b"abcd"
+
+
+def test_stream_halves():
+    halves = [1, 2, 3, 4, 5, 6, 7]
+    for little in [True, False]:
+        with common.Stream() as f:
+            for half in halves:
+                f.writeHalf(half, little)
+            f.writeHalf(0, little)
+            expected = f.readAt(0)
+        with common.Stream() as f:
+            f.writeHalf(halves[0], little)
+            f.writeHalves(halves[1:], little)
+            f.writeHalves([0], little)
+            assert f.readAt(0) == expected
+            f.seek(0)
+            assert list(f.readHalves(3, not little)) == halves[:3]
+            assert f.readHalf(not little) == halves[3]
+            assert list(f.readHalves(4, not little)) == halves[4:] + [0]
+
+
+def test_stream_positional(tmp_path):
+    path = str(tmp_path / "test.bin")
+    with common.Stream(path, "wb") as f:
+        for i in range(0x100):
+            f.writeUInt(i)
+        f.write(b"abc\x00" + b"x" * 0x180 + b"\x00")
+    for mode in ["rb", "mmap"]:
+        with common.Stream(path, mode) as f:
+            f.seek(8)
+            assert common.runThreaded(lambda i: f.readUIntAt(i * 4), range(0x100), 4) == list(range(0x100))
+            assert f.readNullStringAt(0x400) == "abc"
+            assert f.readNullStringAt(0x404) == "x" * 0x180
+            assert f.readStringAt(0x400, 3) == "abc"
+            assert list(f.readArrayAt(4, "I", 2)) == [1, 2]
+            assert f.tell() == 8
+
+
+def test_stream_frombuffer():
+    data = bytearray(b"\x01\x00\x00\x00abc\x00")
+    with common.Stream.fromBuffer(data) as f:
+        assert f.readUInt() == 1
+        assert f.readNullString() == "abc"
+        f.seek(0)
+        f.writeUInt(2)
+        assert data[:4] == b"\x02\x00\x00\x00"
+    f = common.Stream.fromBuffer(memoryview(b"abc\x00def\x00")[4:], False)
+    assert f.readNullStringAt(0) == "def"
+    try:
+        f.write(b"x")
+        assert False
+    except OSError:
+        pass
+
+
+def test_log_lazy(caplog):
+    calls = []
+
+    def payload():
+        calls.append(1)
+        return "payload"
+    with caplog.at_level(logging.INFO):
+        common.logDebug("test", common.Lazy(payload))
+    assert calls == []
+    with caplog.at_level(logging.DEBUG):
+        common.logDebug("test", common.Lazy(payload), common.Lazy(common.toHex, 0x10))
+        # Plain functions are logged as they are, not called
+        common.logDebug("function", payload)
+    assert calls == [1]
+    assert "test payload 10" in caplog.text
+    assert "function <function" in caplog.text
+
+
+def test_profile(tmp_path):
+    path = str(tmp_path / "test.bin")
+    profile.enable(True)
+    try:
+        with profile.stage("test", "write"):
+            with common.Stream(path, "wb") as f:
+                f.write(b"test")
+            with common.Stream(path, "r+b", buffered=True) as f:
+                f.write(b"ab")
+                f.writeUIntAt(0, 0)
+        with common.Stream(path, "rb") as f:
+            f.read(1)
+            f.readUIntAt(0)
+        with common.Stream(path, "mmap") as f:
+            f.readViewAt(1, 2)
+            f.readUShortAt(2)
+        with common.Stream() as f:
+            f.write(b"memory")
+        for _ in common.showProgress([1, 2]):
+            pass
+        profile.dump(str(tmp_path / "profile.json"), str(tmp_path / "trace.json"))
+    finally:
+        profile.disable()
+    with open(str(tmp_path / "profile.json")) as f:
+        results = json.load(f)
+    assert results["stages"]["test"]["calls"] == 1
+    assert results["counters"]["files opened for writing"] == 2
+    assert results["counters"]["files opened for reading"] == 2
+    assert results["counters"]["bytes written"] == 10
+    assert results["counters"]["bytes read"] == 9
+    assert results["counters"]["files processed"] == 2
+    assert "peak" in results
+    with open(str(tmp_path / "trace.json")) as f:
+        assert json.load(f)["traceEvents"][0]["name"] == "test"
+
+
+def test_scan_binary_strings(tmp_path):
+    path = str(tmp_path / "test.bin")
+    rng = random.Random(0)
+    data = bytearray(rng.getrandbits(8) for _ in range(0x4000))
+    for i in range(0, len(data), 0x100):
+        s = rng.choice(["テスト".encode("shift_jis"), "%d文字".encode("shift_jis"), "ABC\nあ".encode("shift_jis"), b"\x83\x40A"])
+        data[i:i + 0x20] = (s + b"\x00").ljust(0x20, b"\x00")
+    with open(path, "wb") as f:
+        f.write(data)
+    funcs = [common.detectEncodedString, common.detectASCIIString, functools.partial(common.detectEncodedString, startascii=[0x41], startenc=[(0x83, 0x40)])]
+    for func in funcs:
+        # Reference implementation, running the detector at every offset
+        strings = []
+        positions = []
+        with common.Stream(path, "rb") as f:
+            while f.tell() < 0x3000:
+                pos = f.tell()
+                check = func(f, "shift_jis")
+                if check != "":
+                    if check not in strings:
+                        strings.append(check)
+                        positions.append([pos])
+                    else:
+                        positions[strings.index(check)].append(pos)
+                    pos = f.tell() - 1
+                f.seek(pos + 1)
+        assert common.extractBinaryStrings(path, [(0, 0x3000)], func) == (strings, positions)
+        assert list(common.findBinaryStrings(path, [(0, 0x3000)], func).items()) == list(zip(strings, positions))
+
+
+def test_find_binary_strings_workers(tmp_path):
+    path = str(tmp_path / "test.bin")
+    rng = random.Random(1)
+    data = bytearray()
+    while len(data) < 0x48000:
+        data += rng.choice(["テスト".encode("shift_jis"), b"%d", b"\x83\x00\x00", bytes(rng.getrandbits(8) for _ in range(0x10))]) + b"\x00"
+    with open(path, "wb") as f:
+        f.write(data)
+    binranges = [(0x10, 0x30000), (0x30000, 0x47000)]
+    found = common.findBinaryStrings(path, binranges)
+    assert len(found) > 0
+    assert common.getBinaryChunks(data, 0, 0x30000, 0x10000)[1][0] > 0x10000
+    assert list(common.findBinaryStrings(path, binranges, workers=2).items()) == list(found.items())
+
+
+def test_pointer_index():
+    rng = random.Random(2)
+    data = bytes(rng.choice([0x00, 0x02, 0x10]) for _ in range(0x2000))
+    unaligned = common.PointerIndex(data, 0x02000000, 0x02002000, 1)
+    aligned = common.PointerIndex(data, 0x02000000, 0x02002000)
+    for pointer in range(0x02000000, 0x02002000, 0x10):
+        search = struct.pack("<I", pointer)
+        # Reference search, as used before the index
+        expected = []
+        index = data.find(search)
+        while index >= 0:
+            expected.append(index)
+            index = data.find(search, index + 4)
+        assert unaligned.find(pointer) == expected
+        assert aligned.find(pointer) == [x for x in range(0, len(data), 4) if data[x:x + 4] == search]
+    assert common.PointerIndex(b"\x02\x02\x02\x02\x02\x02", 0, 0x03000000, 1).find(0x02020202) == [0]
+
+
+def test_free_space():
+    freespace = common.FreeSpace([(0x100, 0x110), (0x200, 0x240), [0x300, 0x320, True]])
+    freespace.add(0x110, 0x120)
+    freespace.add(0x320, 0x330)
+    assert freespace.ranges == [[0x100, 0x120, None], [0x200, 0x240, None], [0x300, 0x320, True], [0x320, 0x330, None]]
+    # Best fit picks the smallest range with room for the terminator
+    assert freespace.find(0x10)[0] == 0x100
+    assert freespace.find(0xf)[0] == 0x320
+    freespace.use(freespace.find(0x1f), 0x11f)
+    assert freespace.ranges[0] == [0x11f, 0x120, None]
+    freespace.remove(0x210, 0x220)
+    assert freespace.ranges[1:3] == [[0x200, 0x210, None], [0x220, 0x240, None]]
+    assert freespace.find(0x40) is None
+    assert freespace.getReport() == "97 bytes free in 5 ranges, largest 32, fragmentation 67.01%, 1 bytes too small to use"
+
+
+def writeBinaryStrings(infile, outfile, strings):
+    data = bytearray(0x600)
+    pos = 0x100
+    for i, string in enumerate(strings):
+        struct.pack_into("<I", data, i * 4, 0x02000000 + pos)
+        encoded = string.encode("shift_jis") + b"\x00"
+        data[pos:pos + len(encoded)] = encoded
+        pos += len(encoded)
+    with open(infile, "wb") as f:
+        f.write(data)
+    with open(outfile, "wb") as f:
+        f.write(data)
+
+
+def test_repack_binary_strings(tmp_path):
+    infile = str(tmp_path / "in.bin")
+    outfile = str(tmp_path / "out.bin")
+    writeBinaryStrings(infile, outfile, ["テスト", "あいう", "えお"])
+    # Pointers are also replaced at unaligned offsets
+    for file in [infile, outfile]:
+        with common.Stream(file, "r+b") as f:
+            f.seek(0x51)
+            f.writeUInt(0x02000107)
+    section = {"テスト": ["テ"], "あいう": ["あいうあいうあいう"], "えお": ["ええおおええおお"]}
+    notfound = common.repackBinaryStrings(section, infile, outfile, [(0x100, 0x200)], [(0x400, 0x500)], pointerstart=0x02000000)
+    assert notfound == []
+    with common.Stream(outfile, "rb") as f:
+        assert f.readUIntAt(0) == 0x02000100
+        assert f.readUIntAt(0x51) == 0x02000400
+        assert f.readEncodedStringAt(0x100, "shift_jis") == "テ"
+        assert f.readUIntAt(4) == 0x02000400
+        assert f.readEncodedStringAt(0x400, "shift_jis") == "あいうあいうあいう"
+        assert f.readUIntAt(8) == 0x02000413
+        assert f.readEncodedStringAt(0x413, "shift_jis") == "ええおおええおお"
+
+
+def test_report_binary_pointers(tmp_path):
+    infile = str(tmp_path / "in.bin")
+    writeBinaryStrings(infile, str(tmp_path / "out.bin"), ["テスト", "あいう"])
+    with common.Stream(infile, "r+b") as f:
+        f.seek(0x20)
+        f.writeUInt(0x02000100)
+        # Only aligned pointers are reported
+        f.seek(0x51)
+        f.writeUInt(0x02000107)
+    assert common.reportBinaryPointers(infile, [(0x100, 0x200)], pointerstart=0x02000000) == {0x100: [0, 0x20], 0x107: [4]}
+
+
+def test_repack_binary_strings_tailmerge(tmp_path):
+    infile = str(tmp_path / "in.bin")
+    outfile = str(tmp_path / "out.bin")
+    writeBinaryStrings(infile, outfile, ["あ", "い", "う", "え"])
+    section = {"あ": ["かきくけこ"], "い": ["けこ"], "う": ["さしすせそ"], "え": ["かきくけこ"]}
+    notfound = common.repackBinaryStrings(section, infile, outfile, [(0x100, 0x200)], [(0x400, 0x500)], pointerstart=0x02000000, tailmerge=True)
+    assert notfound == []
+    with common.Stream(outfile, "rb") as f:
+        pointers = [f.readUIntAt(i * 4) - 0x02000000 for i in range(4)]
+        assert [f.readEncodedStringAt(x, "shift_jis") for x in pointers] == ["かきくけこ", "けこ", "さしすせそ", "かきくけこ"]
+        assert pointers[1] == pointers[0] + 6
+        assert pointers[3] == pointers[0]
+
+
+def test_write_encoded_string():
+    cases = [
+        ("AB|テスト～UNK(8140)", 0, 1, 13, b"AB\n" + "テスト〜".encode("shift_jis") + b"\x81\x40\x00"),
+        ("ABCテスト", 6, 1, -1, b"ABC" + "テ".encode("shift_jis")),
+        ("ABCDEFG", 4, 1, -1, b"ABCD"),
+        ("AB", 4, 2, 3, b"AB\x00\x00"),
+    ]
+    for s, maxlen, zerobytes, length, expected in cases:
+        with common.Stream() as f:
+            assert common.writeEncodedString(f, s, maxlen, "shift_jis", zerobytes) == length
+            assert f.readAt(0) == expected
+
+
+def test_read_encoded_string():
+    data = "テスト〜".encode("shift_jis") + b"A\n\x00" + b"\x85\x40\x83\x01\x00" + b"%d\x00" + b"AB\x00"
+    with common.Stream.fromBuffer(bytearray(data)) as f:
+        assert common.readEncodedString(f) == "テスト～A|"
+        assert common.readEncodedString(f) == "\x85@UNK(8301)"
+        assert f.tell() == 16
+        assert common.detectEncodedString(f) == "%d"
+        assert common.detectEncodedString(f) == ""
+
+
+def test_repack_binary_strings_incremental(tmp_path):
+    infile = str(tmp_path / "in.bin")
+    outfile = str(tmp_path / "out.bin")
+    manifest = str(tmp_path / "out.bin.manifest")
+    fullfile = str(tmp_path / "full.bin")
+
+    def repack(section, file, manifest):
+        # Like nds.repackBIN, the previous output is only kept if the manifest is valid
+        if manifest == "" or common.readRepackManifest(manifest, file) is None:
+            common.copyFile(infile, file)
+        return common.repackBinaryStrings(section, infile, file, [(0x40, 0x200)], [(0x400, 0x500)], pointerstart=0x02000000, manifest=manifest)
+    writeBinaryStrings(infile, outfile, ["テスト", "あいう", "えお", "かき"])
+    # A string ending with the low byte of a pointer to another string
+    with common.Stream(infile, "r+b") as f:
+        f.seek(0x44)
+        f.write("くけ".encode("shift_jis") + b"\x00")
+        f.seek(0x60)
+        f.write("こさ".encode("shift_jis") + struct.pack("<I", 0x02000044))
+    section = {"テスト": ["テ"], "あいう": ["あいうあいうあいう"], "えお": ["ええおお"], "こさD": ["こ"]}
+    repack(section, outfile, manifest)
+    changes = [
+        {"テスト": ["テス"], "あいう": ["あいうあいうあいう"], "えお": ["ええおお"], "こさD": ["こ"]},
+        {"テスト": ["テス"], "あいう": ["あいうあいう"], "えお": ["ええおお"], "かき": ["か"], "こさD": ["こ"]},
+        {"テスト": ["テス"], "あいう": ["あいうあいう"], "かき": ["か"], "くけ": ["くけくけくけ"], "こさD": ["こ"]},
+        {"テスト": ["テス"], "あいう": ["あいうあいう"], "かき": ["か"], "くけ": ["くけくけくけ"]},
+    ]
+    for section in changes:
+        assert repack(dict(section), outfile, manifest) == []
+        with open(manifest) as f:
+            assert json.load(f)["output"] == common.getFileStamp(outfile)
+        repack(dict(section), fullfile, "")
+        with open(outfile, "rb") as f1, open(fullfile, "rb") as f2:
+            assert f1.read() == f2.read()
+
+
+def test_pointer_shift_map():
+    rng = random.Random(3)
+    pointerdiff = {rng.randrange(0x1000): rng.randrange(-8, 8) for _ in range(50)}
+    pointers = [rng.randrange(0x1000) for _ in range(200)] + list(pointerdiff)
+    shiftmap = common.PointerShiftMap(pointerdiff)
+    expected = [common.shiftPointer(x, pointerdiff) for x in pointers]
+    assert [common.shiftPointer(x, shiftmap) for x in pointers] == expected
+    assert shiftmap.shiftMany(array.array("I", pointers)) == array.array("I", expected)
+    shiftmap.add(0, 4)
+    assert shiftmap.shift(1) == common.shiftPointer(1, pointerdiff) + 4
+
+
+def test_translation_file(tmp_path):
+    path = str(tmp_path / "test.xliff")
+    t = common.TranslationFile()
+    t.addEntry("あ", "bin", 0x10, "A")
+    t.addEntry("い", "bin", 0x20)
+    t.addEntry("い", "bin", 0x30, "I#comment")
+    t.addEntry("う", "other", 0x40, "U")
+    t.save(path)
+    t = common.TranslationFile(path)
+    t.preloadLookup()
+    assert t.getEntry("あ", "bin", 0x10) == "A"
+    assert t.getEntry("い", "bin", 0x20) == "I"
+    assert t.getEntry("う", "bin", 0x50) == "U"
+    assert t.getEntry("え", "bin", 0x50) == ""
+    t.setEntry("あ", "bin", 0x10, "")
+    t.setEntry("い", "bin", 0x60, "II")
+    t.addEntry("え", "other", 0x70, "E#comment")
+    assert t.getEntry("あ", "bin", 0x10) == ""
+    assert t.getEntry("い", "bin", 0x20) == "II"
+    assert t.getEntry("え", "bin", 0x70) == "E"
+    # The incremental lookup matches a full rebuild
+    lookup, progress = dict(t.lookup), t.getProgress()
+    t.lookupcomments = None
+    t.preloadLookup()
+    assert t.lookup == lookup
+    assert t.getProgress() == progress
+
+
+def test_translation_file_lookup(tmp_path):
+    path = str(tmp_path / "test.xliff")
+    t = common.TranslationFile()
+    t.addEntry("あ", "bin", 0x10)
+    t.addEntry("あ", "other", 0x20)
+    t.preloadLookup()
+    assert t.getEntry("あ", "other", 0x20) == ""
+    assert t.getProgress() == 0
+    # Text is written as given, comments are only removed in the lookup used by other files
+    t.setEntry("あ", "bin", 0x10, "A#note")
+    assert t.getEntry("あ", "bin", 0x10) == "A#note"
+    assert t.getEntry("あ", "other", 0x20) == "A"
+    assert t.getProgress() == 50
+    t.save(path)
+    t = common.TranslationFile(path)
+    assert t.getEntry("あ", "bin", 0x10) == "A#note"
+    t.preloadLookup()
+    t.setEntry("あ", "bin", 0x10, "")
+    assert t.getEntry("あ", "other", 0x20) == ""
+    assert t.getProgress() == 0
+
+
+def test_translation_file_filter(tmp_path):
+    path = str(tmp_path / "test.xliff")
+    t = common.TranslationFile()
+    for filename in ["a", "b", "c"]:
+        for i in range(10):
+            t.addEntry(filename + str(i), filename, i, "T" + str(i) if i % 2 else "")
+    t.save(path)
+    full = common.TranslationFile(path)
+    filtered = common.TranslationFile(path, ["b"])
+    assert list(filtered.files) == ["b"]
+    assert len(filtered.root) == 1
+    for i in range(10):
+        assert filtered.getEntry("b" + str(i), "b", i) == full.getEntry("b" + str(i), "b", i)
+    assert [ET.tostring(x) for x in filtered.files["b"][0]] == [ET.tostring(x) for x in full.files["b"][0]]
+    # Saving a filtered file is refused, so the other files are kept
+    with open(path, "rb") as f:
+        data = f.read()
+    filtered.setEntry("b1", "b", 1, "new")
+    filtered.save(path)
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert list(common.TranslationFile(path).files) == ["a", "b", "c"]
+
+
+def test_translation_file_save(tmp_path):
+    path = str(tmp_path / "test.xliff")
+    t = common.TranslationFile()
+    t.addEntry("a & <b>", "bin", 0, "tr \"c\"", "note")
+    t.addEntry("d", "bin", 4)
+    t.save(path)
+    with open(path, "r", encoding="utf-8") as f:
+        data = f.read()
+    assert data.startswith("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<xliff version=\"1.2\"")
+    assert "\n      <trans-unit id=\"4\" xml:space=\"preserve\">\n        <source>d</source>\n        <target/>\n      </trans-unit>\n" in data
+    assert "<source>a &amp; &lt;b&gt;</source>" in data
+    # Saving an unchanged file is skipped
+    t = common.TranslationFile(path)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("<!-- untouched -->")
+    t.setEntry("d", "bin", 4, None)
+    t.save(path)
+    with open(path, "r", encoding="utf-8") as f:
+        assert f.read().endswith("<!-- untouched -->")
+    t.setEntry("d", "bin", 4, "e")
+    t.save(path)
+    t = common.TranslationFile(path)
+    assert t.getEntry("d", "bin", 4) == "e"
+    assert t.getEntry("a & <b>", "bin", 0) == "tr \"c\""
+
+
+def test_sections(tmp_path):
+    path1 = str(tmp_path / "a.txt")
+    path2 = str(tmp_path / "b{}.txt")
+    with open(path1, "w", encoding="utf-8") as f:
+        f.write("﻿head=h\n!FILE:one#note\na=A#comment\na=B\n#c=d\n!FILE:two\nb=\n")
+    with open(path2.format("1"), "w", encoding="utf-8") as f:
+        f.write("!FILE:one\na=C\n")
+    with open(path2.format("2"), "w", encoding="utf-8") as f:
+        f.write("!FILE:three\nc=D\n")
+    assert common.getSections(path1) == {"one": {"a": ["A", "B"], "#c": ["d"]}, "two": {"b": [""]}}
+    assert common.getSections(path1, inorder=True)["one"][2] == {"name": "#c=d", "value": ""}
+    sections = common.openSections([path1, path2])
+    assert sections[""] == {"head": ["h"]}
+    assert sections["one"]["a"] == ["A", "B", "C"]
+    assert sections["three"] == {"c": ["D"]}
+    section = common.getCachedSection([path1, path2], "one")
+    assert section["a"] == ["A", "B", "C"]
+    section["a"].pop(0)
+    assert common.getCachedSection([path1, path2], "one")["a"] == ["A", "B", "C"]
+    assert common.getCachedSection([path1, path2], "missing") == {}
+    # Changed files are parsed again
+    with open(path1, "w", encoding="utf-8") as f:
+        f.write("!FILE:one\na=E\n")
+    assert common.getCachedSection([path1, path2], "one")["a"] == ["E", "C"]
+
+
+def test_sections_empty_title(tmp_path):
+    file = str(tmp_path / "empty.txt")
+    with open(file, "w", encoding="utf-8") as f:
+        f.write("!FILE:\na=b\n!FILE:one\nc=d\n")
+    sections = common.getSections(file)
+    assert sections == {"": {"a": ["b"]}, "one": {"c": ["d"]}}
+    with open(file, "w", encoding="utf-8") as f:
+        f.write("a=b\nc=\n")
+    assert common.getSections(file) == {}
+    assert common.getCachedSection(file, "") == {"a": ["b"], "c": [""]}
+
+
+def test_merge_sections(tmp_path):
+    path1 = str(tmp_path / "a.txt")
+    path2 = str(tmp_path / "b.txt")
+    output = str(tmp_path / "out.txt")
+    with open(path1, "w", encoding="utf-8") as f:
+        f.write("!FILE:one\n#comment\na=\nb=B1\nc=\n!FILE:two\nd=\n")
+    with open(path2, "w", encoding="utf-8") as f:
+        f.write("!FILE:x\na=\nb=B2\nc=C1\n!FILE:y\na=A1\nc=C2\nd=D\n")
+    conflicts = common.mergeSections(path1, path2, output)
+    with open(output, "r", encoding="utf-8") as f:
+        assert f.read() == "!FILE:one\n#comment\na=A1\nb=B1\nc=C1\n!FILE:two\nd=D\n"
+    assert conflicts == {"b": ["B1", "B2"], "c": ["C1", "C2"]}
+
+
+def test_gim_truncated(tmp_path, caplog):
+    import benchmark
+    from hacktools import psp
+    file = str(tmp_path / "test.gim")
+    benchmark.writeGIM(file, 32, 16)
+    with open(file, "rb") as f:
+        data = f.read()
+    # Cut the image block in the middle of its pixel data
+    image = psp.GIMImage()
+    with common.Stream.fromBuffer(data[:0x50 + 0x40]) as f:
+        f.seek(0x30)
+        with caplog.at_level(logging.DEBUG):
+            psp.readGIMBlock(f, psp.GIM(), image)
+    assert len(image.colors) == 0x80
+    assert "Malformed GIM image data at 30" in caplog.text
+
+
+def test_cpk_utf_data():
+    from hacktools import cpk
+    packet = b"@UTF" + bytes(range(12))
+    assert isinstance(cpk.decryptUTF(packet), bytes)
+    with common.Stream.fromBuffer(struct.pack("<iq", 0, len(packet)) + cpk.decryptUTF(packet)) as f:
+        packetstream, size, encrypted = cpk.readUTFData(f)
+    assert size == len(packet) and encrypted
+    assert packetstream.read() == packet
+    packetstream.seek(4)
+    packetstream.writeUInt(0x12345678)
+    utf = cpk.UTF()
+    utf.dataoffset = 0
+    with common.Stream.fromBuffer(struct.pack(">ii", 8, 4) + b"data", False) as f:
+        data, type = cpk.readUTFTypedData(f, utf, cpk.UTFStructTypes.DATA_TYPE_BYTEARRAY)
+    assert type == cpk.UTFStructTypes.DATA_TYPE_BYTEARRAY
+    assert isinstance(data, bytes) and data == b"data"
+
+
+def test_cpk_repack_itoc(tmp_path):
+    import benchmark
+    from hacktools import cpk
+    files = [bytes([i + 1]) * (0x800 - i * 0x400) for i in range(2)]
+    rows = [[i, len(files[i]), len(files[i])] for i in range(len(files))]
+    datah = benchmark.getUTF([("ID", 2), ("FileSize", 4), ("ExtractSize", 4)], rows, "CpkItocH")
+    itoc = benchmark.getUTF([("DataH", 0xb)], [[datah]], "CpkItocInfo")
+    header = benchmark.getUTF([("TocOffset", 6), ("ItocOffset", 6), ("ContentOffset", 6), ("Files", 4), ("Align", 2)], [[0xffffffffffffffff, 0x800, 0x1000, len(files), 0x800]], "CpkHeader")
+    file = str(tmp_path / "itoc.cpk")
+    with common.Stream(file, "wb") as f:
+        benchmark.writeCPKPacket(f, b"CPK ", header)
+        f.writeZero(0x800 - f.tell())
+        benchmark.writeCPKPacket(f, b"ITOC", itoc)
+        f.writeZero(0x1000 - f.tell())
+        f.write(files[0])
+        f.write(files[1])
+    infolder = str(tmp_path / "in") + "/"
+    outfolder = str(tmp_path / "out") + "/"
+    cpk.extract(file, infolder)
+    common.makeFolder(outfolder)
+    with open(outfolder + "ID00000", "wb") as f:
+        f.write(b"\x03" * 0x900)
+    cpk.repack(file, str(tmp_path / "new.cpk"), infolder, outfolder)
+    entries = cpk.readCPK(str(tmp_path / "new.cpk")).getEntries("FILE")
+    assert [(x.id, x.filesize, x.extractsize, x.fileoffset) for x in entries] == [(0, 0x900, 0x900, 0x1000), (1, 0x400, 0x400, 0x2000)]
+    cpk.extract(str(tmp_path / "new.cpk"), str(tmp_path / "check") + "/")
+    with open(str(tmp_path / "check" / "ID00001"), "rb") as f:
+        assert f.read() == files[1]